@@ -0,0 +1,428 @@
+# /usr/bin/python3
+
+"""
+    Benchmark suite of the tools of this repository. It generates reproducible
+    fixtures (a directory tree, a log file, nieuwsblad.be pages and Yahoo forecast
+    responses) from a seed, times the hot paths of every tool against them and
+    appends the throughput of every benchmark to a JSON Lines results file, so
+    runs can be compared over time.
+
+    Copyright (C) 2017 rafael valera
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import argparse
+import contextlib
+import datetime
+import http.server
+import json
+import os
+import platform
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+# the tools and instrumentation.py of this repository come before any installed module of the same name
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+for directory in ("filecollector", "simplelog", "windgoes", "news", ""):
+    sys.path.insert(0, os.path.join(ROOT, directory))
+
+import file_collector
+import hetnieuwsblad
+import instrumentation
+import simple_log
+import windforecast
+
+WORDS = ("de", "het", "een", "wind", "regen", "stad", "match", "ploeg", "minister", "school", "trein", "brand",
+         "politie", "zomer", "request", "user", "session", "timeout", "cache", "server", "disk", "worker")
+LEVELS = ("DEBUG", "INFO", "INFO", "INFO", "WARNING", "ERROR")
+EXTENSIONS = file_collector.docs + file_collector.images + file_collector.audios + file_collector.videos + (".log",)
+# the extensions of --media, matched against synthetic names by the filecollector.match benchmarks
+MEDIA_EXTENSIONS = file_collector.audios + file_collector.images + file_collector.docs + file_collector.videos
+MATCH_NAMES = 1000000
+
+
+def get_sentence(generator, words):
+    return " ".join(generator.choice(WORDS) for _ in range(words))
+
+
+class Fixtures:
+    """ Generates the fixtures of the benchmarks in a work directory. Fixtures are generated
+        once per set of parameters and reused by later runs """
+
+    def __init__(self, directory, seed=2017, files=2000, log_size=256 * 1024 * 1024, articles=50, locations=200):
+        self.directory = directory
+        self.parameters = {"seed": seed, "files": files, "log_size": log_size, "articles": articles,
+                           "locations": locations}
+        self.tree = os.path.join(directory, "tree")
+        self.log = os.path.join(directory, "log.txt")
+        self.pages = os.path.join(directory, "pages")
+        self.forecasts = os.path.join(directory, "forecasts")
+        self.locations = ["City{:04d}".format(number) for number in range(locations)]
+        self.page_server = None
+        self.names = None
+
+    def prepare(self):
+        """ Generates the fixtures unless they were generated with the same parameters """
+        marker = os.path.join(self.directory, "fixtures.json")
+        try:
+            with open(marker) as marker_file:
+                if json.load(marker_file) == self.parameters:
+                    return self
+        except (IOError, ValueError):
+            pass
+        shutil.rmtree(self.directory, ignore_errors=True)
+        os.makedirs(self.directory)
+        seed = self.parameters["seed"]
+        self.__make_tree(random.Random(seed))
+        self.__make_log(random.Random(seed))
+        self.__make_pages(random.Random(seed))
+        self.__make_forecasts(random.Random(seed))
+        with open(marker, "w") as marker_file:
+            json.dump(self.parameters, marker_file)
+        return self
+
+    def get_names(self):
+        """ Returns MATCH_NAMES synthetic file names, built on first use and kept in memory. About
+            a third of them have a --media extension, in mixed case """
+        if self.names is None:
+            generator = random.Random(self.parameters["seed"])
+            others = (".py", ".html", ".json", ".tmp", ".bak", ".tar.gz", ".log", "")
+            suffixes = [extension.upper() if number % 4 == 0 else extension
+                        for number, extension in enumerate(MEDIA_EXTENSIONS + others * 11)]
+            self.names = ["{}_{}{}".format(generator.choice(WORDS), number, generator.choice(suffixes))
+                          for number in range(MATCH_NAMES)]
+        return self.names
+
+    def get_pages_url(self):
+        """ Returns the url of the generated pages, served by a PageServer started on first use """
+        if self.page_server is None:
+            self.page_server = PageServer(self.pages)
+        return self.page_server.url
+
+    def close(self):
+        if self.page_server is not None:
+            self.page_server.close()
+            self.page_server = None
+
+    def __make_tree(self, generator):
+        """ Text, office and media files up to three levels deep, one in ten a copy of another """
+        kinds = ((".txt", True), (".pdf", True), (".docx", False), (".jpg", False), (".mp3", False), (".mp4", False),
+                 (".log", True))
+        created = []
+        for number in range(self.parameters["files"]):
+            directory = os.path.join(self.tree, *("d{}".format(generator.randrange(8))
+                                                  for _ in range(generator.randrange(4))))
+            os.makedirs(directory, exist_ok=True)
+            extension, is_text = generator.choice(kinds)
+            path = os.path.join(directory, "file{:05d}{}".format(number, extension))
+            if created and generator.random() < 0.1:
+                shutil.copyfile(generator.choice(created), path)
+                continue
+            size = int(generator.paretovariate(1.2) * 4096) % (8 * 1024 * 1024)
+            with open(path, "wb") as fixture:
+                if is_text:
+                    fixture.write(get_sentence(generator, size // 6).encode("ascii")[:size])
+                else:
+                    fixture.write(generator.randbytes(size))
+            created.append(path)
+
+    def __make_log(self, generator):
+        """ ISO timestamped log entries, a second apart, written one block at a time """
+        timestamp = datetime.datetime(2017, 4, 23).timestamp()
+        written = 0
+        with open(self.log, "w") as log_file:
+            while written < self.parameters["log_size"]:
+                lines = []
+                for _ in range(10000):
+                    timestamp += 1
+                    lines.append("{} {} {} id={}\n".format(
+                        datetime.datetime.fromtimestamp(timestamp).isoformat(), generator.choice(LEVELS),
+                        get_sentence(generator, generator.randrange(4, 14)), generator.randrange(10 ** 6)))
+                block = "".join(lines)
+                log_file.write(block)
+                written += len(block)
+
+    def __make_pages(self, generator):
+        """ A main page with headline teasers inside a heavy layout, and the article pages it links to """
+        os.makedirs(self.pages)
+        navigation = "".join('<li><a href="/rubriek/{0}">{0}</a></li>'.format(word) for word in WORDS)
+        scripts = "".join("<script>window.tracker{}={{}};</script>".format(number) for number in range(40))
+        teasers = []
+        for number in range(200):
+            link = "/cnt/dmf20170423_{:08d}".format(number % self.parameters["articles"])
+            teasers.append('<article class="teaser"><a class="link-complex teaser__link" href="{}"><figure>'
+                           '<img src="/img/{}.jpg" alt=""></figure><h1> {} </h1><p>{}</p></a><ul>{}</ul>'
+                           '</article>'.format(link, number, get_sentence(generator, 8).capitalize(),
+                                               get_sentence(generator, 20), navigation))
+        with open(os.path.join(self.pages, "index.html"), "w") as page:
+            page.write("<html><head>{}</head><body><nav><ul>{}</ul></nav><main>{}</main></body></html>".format(
+                scripts, navigation, "".join(teasers)))
+
+        footer = "".join("<p>{}</p>".format(get_sentence(generator, 12)) for _ in range(60))
+        for number in range(self.parameters["articles"]):
+            paragraphs = "".join("<p>{}</p>".format(get_sentence(generator, generator.randrange(30, 120)))
+                                 for _ in range(15))
+            with open(os.path.join(self.pages, "dmf20170423_{:08d}.html".format(number)), "w") as page:
+                page.write('<html><head>{}</head><body><nav><ul>{}</ul></nav><h1 itemprop="name">{}</h1>'
+                           '<time itemprop="datePublished" datetime="2017-04-23 {:02d}:{:02d}+02:00"></time>'
+                           '<div class="article__body">{}</div><footer>{}</footer></body></html>'.format(
+                               scripts, navigation, get_sentence(generator, 8).capitalize(), number % 24,
+                               number % 60, paragraphs, footer))
+
+    def __make_forecasts(self, generator):
+        """ Recorded woeid and forecast responses of every location, served by a ReplayProvider """
+        os.makedirs(self.forecasts)
+        handler = windforecast.YahooForecastAPIHandler
+        for number, location in enumerate(self.locations):
+            woeid = str(1000000 + number)
+            place = {"query": {"count": 1, "results": {"place": {"woeid": woeid}}}}
+            forecast = {"query": {"count": 1, "results": {"channel": {
+                "location": {"city": location, "country": "Belgium", "region": " VLG"},
+                "wind": {"chill": str(generator.randrange(30, 70)), "direction": str(generator.randrange(360)),
+                         "speed": str(generator.randrange(120))},
+                "atmosphere": {"humidity": str(generator.randrange(100)), "pressure": "1015.0", "visibility": "16.1"},
+                "item": {"lat": "{:.6f}".format(generator.uniform(50, 51.5)),
+                         "long": "{:.6f}".format(generator.uniform(2.5, 6)),
+                         "forecast": [{"code": str(generator.randrange(48)), "day": day, "high": "61", "low": "45",
+                                       "text": "Partly Cloudy"} for day in ("Sun", "Mon", "Tue", "Wed", "Thu",
+                                                                           "Fri", "Sat", "Sun", "Mon", "Tue")]}}}}}
+            for url, response in ((handler.woeid_url.format(cityname=location), place),
+                                  (handler.wind_forecast_url.format(woeid=woeid), forecast)):
+                with open(windforecast.ReplayProvider.get_fixture_path(self.forecasts, url), "w") as fixture:
+                    json.dump(response, fixture)
+
+
+class PageServer:
+    """ Serves the generated pages over HTTP on localhost, so the scraper runs end to end """
+
+    def __init__(self, directory):
+        class Handler(http.server.SimpleHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def __init__(self, *args, **kwargs):
+                super().__init__(*args, directory=directory, **kwargs)
+
+            def translate_path(self, path):
+                name = "index.html" if path.strip("/") == "" else path.rsplit("/", 1)[-1] + ".html"
+                return os.path.join(directory, name)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = "http://127.0.0.1:{}/".format(self.server.server_port)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def get_size(collected_files):
+    return sum(os.path.getsize(collected_file.get_absolute_file_path()) for collected_file in collected_files)
+
+
+def benchmark_walk(fixtures, work):
+    return len(list(file_collector.collect_files(fixtures.tree, EXTENSIONS))), 0
+
+
+def benchmark_match_scan(fixtures, work):
+    # the tuple scan FileMatcher replaced, the reference of filecollector.match; the names are
+    # built by the first of the --repeat runs, which the fastest run leaves out
+    names = fixtures.get_names()
+    return sum(1 for name in names if name.lower().endswith(MEDIA_EXTENSIONS)), 0
+
+
+def benchmark_match(fixtures, work):
+    names = fixtures.get_names()
+    matches = file_collector.FileMatcher(MEDIA_EXTENSIONS).matches
+    return sum(1 for name in names if matches(name)), 0
+
+
+def benchmark_archive(fixtures, work):
+    container = os.path.join(work, "archive.zip")
+    if os.path.exists(container):
+        os.remove(container)
+    collected_files = list(file_collector.collect_files(fixtures.tree, EXTENSIONS))
+    return file_collector.ZipStreamWriter(container).write(collected_files), get_size(collected_files)
+
+
+def benchmark_append(fixtures, work):
+    # the per-file path the streaming writer replaces: the zip file is opened once for every file
+    container = os.path.join(work, "append.zip")
+    if os.path.exists(container):
+        os.remove(container)
+    collected_files = list(file_collector.collect_files(fixtures.tree, EXTENSIONS))
+    appended = sum(file_collector.append_to_zipfile(container, collected_file) for collected_file in collected_files)
+    return appended, get_size(collected_files)
+
+
+def benchmark_dedup(fixtures, work):
+    collected_files = list(file_collector.collect_files(fixtures.tree, EXTENSIONS))
+    return len(list(file_collector.Deduplicator(jobs=4).filter_unique(collected_files))), get_size(collected_files)
+
+
+def benchmark_scan(fixtures, work):
+    patterns = simple_log.PatternSet([re.compile(r"ERROR .*timeout", re.IGNORECASE)])
+    matches = sum(1 for _ in simple_log.get_matches(fixtures.log, patterns))
+    return matches, os.path.getsize(fixtures.log)
+
+
+def benchmark_scan_many(fixtures, work):
+    patterns = simple_log.PatternSet([re.compile(regex, re.IGNORECASE)
+                                      for regex in (r"ERROR .*timeout", r"WARNING .*disk", r"id=12345\d$")])
+    matches = sum(1 for _ in simple_log.get_matches(fixtures.log, patterns))
+    return matches, os.path.getsize(fixtures.log)
+
+
+def benchmark_forecasts(fixtures, work):
+    handler = windforecast.YahooForecastAPIHandler
+    handler.provider = windforecast.ReplayProvider(fixtures.forecasts)
+    handler.woeid_cache.clear()
+    handler.forecast_cache.clear()
+    return len(handler.get_wind_forecasts(fixtures.locations)), 0
+
+
+def benchmark_beaufort(fixtures, work):
+    speeds = [speed % 130 for speed in range(1000000)]
+    if windforecast.numpy is not None:
+        windforecast.BeaufortScaleParser.get_wind_categories(speeds)
+        windforecast.DirectionParser.get_directions(speeds)
+    else:
+        for speed in speeds:
+            windforecast.BeaufortScaleParser.get_wind_category(speed)
+            windforecast.DirectionParser.get_direction(speed % 360)
+    return len(speeds), 0
+
+
+def benchmark_headlines(fixtures, work):
+    return len(list(hetnieuwsblad.HetNieuwsblad.get_headlines(fixtures.get_pages_url()))), 0
+
+
+def benchmark_crawl(fixtures, work):
+    # every article is linked by several teasers of the main page, it is crawled once
+    headlines = {news_event.link: news_event
+                 for news_event in hetnieuwsblad.HetNieuwsblad.get_headlines(fixtures.get_pages_url())}
+    news_events = list(hetnieuwsblad.NewsCrawler(rate_per_host=0).crawl(headlines.values()))
+    return len(news_events), sum(len(paragraph) for news_event in news_events
+                                 for paragraph in news_event.get_paragraphs())
+
+
+BENCHMARKS = (
+    ("filecollector.walk", benchmark_walk),
+    ("filecollector.match-scan", benchmark_match_scan),
+    ("filecollector.match", benchmark_match),
+    ("filecollector.archive", benchmark_archive),
+    ("filecollector.append", benchmark_append),
+    ("filecollector.dedup", benchmark_dedup),
+    ("simplelog.scan", benchmark_scan),
+    ("simplelog.scan-many", benchmark_scan_many),
+    ("windgoes.forecasts", benchmark_forecasts),
+    ("windgoes.beaufort", benchmark_beaufort),
+    ("news.headlines", benchmark_headlines),
+    ("news.crawl", benchmark_crawl),
+)
+
+
+def get_commit():
+    try:
+        return subprocess.run(["git", "-C", ROOT, "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def load_previous(results_file):
+    """ Returns the last result of every benchmark and parameters in a results file """
+    previous = {}
+    try:
+        with open(results_file) as results:
+            for line in results:
+                result = json.loads(line)
+                previous[(result["benchmark"], json.dumps(result["parameters"], sort_keys=True))] = result
+    except (IOError, ValueError):
+        pass
+    return previous
+
+
+def main():
+    flags_parser = argparse.ArgumentParser(description="Times the tools of this repository on generated fixtures and "
+                                                       "appends their throughput to a results file")
+    flags_parser.add_argument("benchmarks", help="names or name prefixes of the benchmarks to run (default: all)",
+                              nargs="*")
+    flags_parser.add_argument("--work-dir", help="directory the fixtures are generated in", type=str,
+                              default=os.path.join(tempfile.gettempdir(), "literate-adventure-benchmarks"))
+    flags_parser.add_argument("--results", help="JSON Lines file results are appended to "
+                                                "(default: results.jsonl in the work directory)", type=str)
+    flags_parser.add_argument("--seed", help="seed of the generated fixtures (default: 2017)", type=int, default=2017)
+    flags_parser.add_argument("--files", help="number of files of the directory tree (default: 2000)", type=int,
+                              default=2000)
+    flags_parser.add_argument("--log-size", help="size of the log file, accepts K, M and G suffixes "
+                                                 "(default: 256M)", type=simple_log.parse_size, default="256M")
+    flags_parser.add_argument("--repeat", help="runs of every benchmark, the fastest one is kept (default: 3)",
+                              type=int, default=3)
+    flags_parser.add_argument("--list", help="lists the benchmarks and exits", action="store_true", default=False)
+    arguments = flags_parser.parse_args()
+
+    if arguments.list:
+        for name, _ in BENCHMARKS:
+            print(name)
+        return
+
+    selected = [(name, benchmark) for name, benchmark in BENCHMARKS
+                if not arguments.benchmarks or any(name.startswith(prefix) for prefix in arguments.benchmarks)]
+    if not selected:
+        print("Benchmark error: no benchmark matches {}".format(" ".join(arguments.benchmarks)))
+        sys.exit(1)
+
+    print("Preparing fixtures in " + arguments.work_dir)
+    fixtures = Fixtures(os.path.join(arguments.work_dir, "fixtures"), seed=arguments.seed, files=arguments.files,
+                        log_size=arguments.log_size).prepare()
+    work = os.path.join(arguments.work_dir, "work")
+    os.makedirs(work, exist_ok=True)
+    results_file = arguments.results or os.path.join(arguments.work_dir, "results.jsonl")
+    previous = load_previous(results_file)
+    commit = get_commit()
+
+    print("{:<24} {:>10} {:>12} {:>12} {:>10}".format("benchmark", "seconds", "items/s", "bytes/s", "speedup"))
+    with open(results_file, "a") as results, contextlib.closing(fixtures):
+        for name, benchmark in selected:
+            timings = []
+            for _ in range(arguments.repeat):
+                started = time.perf_counter()
+                items, size = benchmark(fixtures, work)
+                timings.append(time.perf_counter() - started)
+            seconds = min(timings)
+            result = {"benchmark": name, "time": datetime.datetime.now().isoformat(timespec="seconds"),
+                      "commit": commit, "python": platform.python_version(), "cpus": os.cpu_count(),
+                      "parameters": fixtures.parameters, "seconds": seconds, "items": items, "bytes": size,
+                      "items_per_second": items / seconds, "bytes_per_second": size / seconds}
+            last = previous.get((name, json.dumps(fixtures.parameters, sort_keys=True)))
+            change = "{:+.1f}%".format(100.0 * (last["seconds"] / seconds - 1)) if last else ""
+            print("{:<24} {:>10.3f} {:>12} {:>12} {:>10}".format(
+                name, seconds, instrumentation.format_rate(result["items_per_second"]),
+                instrumentation.format_rate(result["bytes_per_second"]) if size else "", change))
+            results.write(json.dumps(result) + "\n")
+            results.flush()
+
+
+if __name__ == "__main__":
+    main()
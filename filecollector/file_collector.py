@@ -21,10 +21,39 @@
 """
 
 import argparse
+import collections
+import concurrent.futures
+import contextlib
+import fnmatch
+import functools
+import hashlib
+import importlib.util
+import io
+import json
 import os
+import re
+import sqlite3
+import stat
 import sys
+import time
+import types
 import warnings
 import zipfile
+import zlib
+
+# --stats and --profile come from instrumentation.py at the root of the repository. It is loaded by
+# path so the tool runs from any directory, a copy of the tool on its own runs without the two flags
+try:
+    instrumentation_spec = importlib.util.spec_from_file_location("instrumentation", os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), os.pardir, "instrumentation.py"))
+    instrumentation = importlib.util.module_from_spec(instrumentation_spec)
+    instrumentation_spec.loader.exec_module(instrumentation)
+except FileNotFoundError:
+    instrumentation = types.SimpleNamespace(
+        stats=types.SimpleNamespace(stage=lambda name: contextlib.nullcontext(), count=lambda name, amount=1: None,
+                                    iterate=lambda name, iterable: iterable),
+        add_arguments=lambda parser: parser.set_defaults(stats=False, profile=None),
+        session=lambda enable_stats=False, profile_file=None: contextlib.nullcontext())
 
 docs = (".txt", ".doc", ".xls", ".xlsx", ".docx", ".pdf", ".odt")
 videos = ('.m1v', '.mpeg', '.mov', '.qt', '.mpa', '.mpg', '.mpe', '.avi', '.movie', '.mp4')
@@ -32,12 +61,19 @@ audios = ('.ra', '.aif', '.aiff', '.aifc', '.wav', '.au', '.snd', '.mp3', '.mp2'
 images = ('.ras', '.xwd', '.bmp', '.jpe', '.jpg', '.jpeg', '.xpm', '.ief', '.pbm',
           '.tif', '.gif', '.ppm', '.xbm', '.tiff', '.rgb', '.pgm', '.png', '.pnm')
 
+# media formats of the tuples above that are already compressed, deflating them again only costs time
+compressed_media = ('.jpe', '.jpg', '.jpeg', '.gif', '.png', '.m1v', '.mpeg', '.mov', '.qt', '.mpa', '.mpg', '.mpe',
+                    '.avi', '.movie', '.mp4', '.ra', '.mp3', '.mp2')
+
 
 class CollectedFile:
-    def __init__(self, file_path):
+    def __init__(self, file_path, filename=None):
         self.file_path = file_path
-        self.filename = os.path.basename(file_path)
-        self.extension = os.path.splitext(file_path)
+        self.filename = filename or os.path.basename(file_path)
+
+    @property
+    def extension(self):
+        return os.path.splitext(self.file_path)
 
     def get_absolute_file_path(self):
         return self.file_path
@@ -55,28 +91,758 @@ class CollectedFile:
 def append_to_zipfile(container, file, verbose=False):
     """
         Appends file to zipfile. If verbose, prints the filename
-        lto the standard output stream
+        lto the standard output stream. A file that can not be read
+        is skipped and reported on the standard error stream, the
+        program exits if the zipfile can not be opened or written
 
         :param container: zip file full path
         :param file: file to be added
         :param verbose: if true, prints '.../{filename}' to stdout
 
+        returns: True if the file was appended
     """
+    check_write_zip_entry()
     append = "a"
-    with warnings.catch_warnings():
+    file_path = file.get_absolute_file_path()
+    try:
+        zip_info = zipfile.ZipInfo.from_file(file_path, file.get_filename())
+        source = open(file_path, "rb")
+    except OSError as os_error:
+        print("Skipped: {}".format(os_error), file=sys.stderr)
+        return False
+
+    zip_info.CRC = 0
+    with source, warnings.catch_warnings():
+        warnings.simplefilter("ignore")
         try:
-            warnings.simplefilter("ignore")
             with zipfile.ZipFile(container, append) as temp_zipfile:
-                temp_zipfile.write(file.get_absolute_file_path(), file.get_filename())
-        except FileNotFoundError as not_found_exception:
-            print(not_found_exception, file=sys.stderr)
+                read_error = write_zip_entry(temp_zipfile, zip_info, read_chunks(source, zip_info))
+        except (OSError, zipfile.LargeZipFile) as archive_error:
+            print(archive_error, file=sys.stderr)
             sys.exit(1)
+    if read_error:
+        print("Skipped: {}".format(read_error), file=sys.stderr)
+        return False
+    if verbose:
+        print("..." + file_path, file=sys.stdout)
+    return True
+
+
+def deflate_file(file_path, compress_level=zlib.Z_DEFAULT_COMPRESSION, chunk_size=1024 * 1024):
+    """
+        Reads a file in chunks and compresses it as a raw deflate stream, the
+        format zip archives store for ZIP_DEFLATED entries. zlib releases the
+        GIL while compressing, so this runs in parallel on worker threads.
+
+        :param file_path: file to be compressed
+        :param compress_level: zlib compression level
+        :param chunk_size: bytes read from the file on each iteration
+
+        returns: a (compressed bytes, crc32, uncompressed size) tuple
+    """
+    compressor = zlib.compressobj(compress_level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    compressed_chunks = []
+    crc = 0
+    file_size = 0
+    with instrumentation.stats.stage("deflate"), open(file_path, "rb") as file_object:
+        for chunk in iter(lambda: file_object.read(chunk_size), b""):
+            crc = zlib.crc32(chunk, crc)
+            file_size += len(chunk)
+            compressed_chunks.append(compressor.compress(chunk))
+        compressed_chunks.append(compressor.flush())
+    instrumentation.stats.count("bytes deflated", file_size)
+    return b"".join(compressed_chunks), crc, file_size
+
+
+def read_file(file_path):
+    """
+        Reads a file that is stored without compression.
+
+        :param file_path: file to be read
+
+        returns: a (file bytes, crc32, size) tuple
+    """
+    with instrumentation.stats.stage("read"), open(file_path, "rb") as file_object:
+        data = file_object.read()
+    instrumentation.stats.count("bytes stored", len(data))
+    return data, zlib.crc32(data), len(data)
+
+
+def read_chunks(file_object, zip_info, compress_level=zlib.Z_DEFAULT_COMPRESSION, buffer_size=4 * 1024 * 1024):
+    """
+        Reads an open file buffer_size bytes at a time into a reused buffer
+        and yields it compressed as zip_info.compress_type says, ZIP_DEFLATED
+        or ZIP_STORED, keeping the CRC and sizes of zip_info up to date. A
+        chunk is only valid until the next one is requested.
+
+        :param file_object: file opened in binary mode
+        :param zip_info: ZipInfo of the entry the chunks are written to
+        :param compress_level: zlib compression level
+        :param buffer_size: bytes read from the file on each iteration
+
+        yields: compressed bytes
+    """
+    compressor = None
+    if zip_info.compress_type == zipfile.ZIP_DEFLATED:
+        compressor = zlib.compressobj(compress_level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    zip_info.CRC = zip_info.file_size = zip_info.compress_size = 0
+    buffer = bytearray(buffer_size)
+    with memoryview(buffer) as view:
+        for read in iter(lambda: file_object.readinto(buffer), 0):
+            chunk = view[:read]
+            zip_info.CRC = zlib.crc32(chunk, zip_info.CRC)
+            zip_info.file_size += read
+            if compressor:
+                chunk = compressor.compress(chunk)
+            zip_info.compress_size += len(chunk)
+            yield chunk
+    if compressor:
+        chunk = compressor.flush()
+        zip_info.compress_size += len(chunk)
+        yield chunk
+
+
+def write_zip_entry(archive, zip_info, chunks):
+    """
+        Appends an entry made of already compressed chunks to an open zip
+        file. zip_info.CRC, file_size and compress_size must be final once
+        the chunks are exhausted, the local header is written again with
+        them. This is the only code relying on zipfile internals, it mirrors
+        what ZipFile.open(..., "w") does, minus the compression.
+
+        An OSError raised while getting the chunks, that is while reading the
+        source file, leaves the entry out of the archive and is returned.
+        Errors writing the archive itself are raised.
+
+        :param archive: ZipFile opened in append mode
+        :param zip_info: ZipInfo of the entry
+        :param chunks: iterable of compressed bytes
+
+        returns: None, or the OSError that interrupted reading the source file
+    """
+    zip64 = zip_info.file_size * 1.05 > zipfile.ZIP64_LIMIT
+    zip_info.flag_bits = 0
+    archive._writecheck(zip_info)
+    archive._didModify = True
+    archive.fp.seek(archive.start_dir)
+    zip_info.header_offset = archive.fp.tell()
+    archive.fp.write(zip_info.FileHeader(zip64))
+    chunks = iter(chunks)
+    while True:
+        try:
+            chunk = next(chunks)
+        except StopIteration:
+            break
+        except OSError as read_error:
+            # start_dir did not move, the next entry or the central directory is written over this one
+            return read_error
+        archive.fp.write(chunk)
+    if not zip64 and max(zip_info.file_size, zip_info.compress_size) > zipfile.ZIP64_LIMIT:
+        raise zipfile.LargeZipFile("{} grew past the zip64 limit while being read".format(zip_info.filename))
+
+    end = archive.fp.tell()
+    archive.fp.seek(zip_info.header_offset)
+    archive.fp.write(zip_info.FileHeader(zip64))
+    archive.fp.seek(end)
+    archive.start_dir = end
+    archive.filelist.append(zip_info)
+    archive.NameToInfo[zip_info.filename] = zip_info
+    return None
+
+
+@functools.lru_cache(maxsize=None)
+def check_write_zip_entry():
+    """
+        Round trip of write_zip_entry through an in-memory zip file, run once
+        before the first entry is written since it depends on zipfile internals
+        that can change between Python versions: a new archive as a new volume
+        gets a deflated entry, an entry whose source fails while being read and
+        a stored entry, it is then opened again in append mode for one more
+        entry, and read back with ZipFile.testzip().
+
+        raises: RuntimeError if the entries can not be read back
+    """
+    def failing_chunks():
+        yield b"lost"
+        raise OSError("read error")
+
+    contents = {"deflated.txt": b"deflated " * 1000, "stored.jpg": bytes(range(256)) * 40,
+                "appended.txt": b"appended " * 1000}
+    buffer = io.BytesIO()
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            for mode, names in (("w", ("deflated.txt", "failed.txt", "stored.jpg")), ("a", ("appended.txt",))):
+                with zipfile.ZipFile(buffer, mode) as archive:
+                    for name in names:
+                        zip_info = zipfile.ZipInfo(name, (2017, 4, 23, 14, 0, 0))
+                        zip_info.compress_type = zipfile.ZIP_STORED if name.endswith(".jpg") else zipfile.ZIP_DEFLATED
+                        zip_info.file_size = zip_info.CRC = 0
+                        if name in contents:
+                            chunks = read_chunks(io.BytesIO(contents[name]), zip_info, buffer_size=1024)
+                        else:
+                            chunks = failing_chunks()
+                        if (write_zip_entry(archive, zip_info, chunks) is None) != (name in contents):
+                            raise zipfile.BadZipFile("{} was not written as expected".format(name))
+        with zipfile.ZipFile(buffer) as archive:
+            bad_entry = archive.testzip()
+            if bad_entry is not None:
+                raise zipfile.BadZipFile("bad CRC or header of " + bad_entry)
+            if {name: archive.read(name) for name in archive.namelist()} != contents:
+                raise zipfile.BadZipFile("entries read back differ")
+    except (zipfile.BadZipFile, zipfile.LargeZipFile, AttributeError, TypeError, ValueError) as error:
+        raise RuntimeError("writing zip entries is not supported by this zipfile module: {}".format(error))
+
+
+class ZipStreamWriter:
+    """
+        Stores CollectedFile objects in a zip file that is opened only once,
+        so the central directory is read and written a single time instead of
+        once per file. Files are deflated by a pool of worker threads and the
+        compressed entries are written to the archive in submission order.
+        Files with an already compressed extension are stored as they are.
+        Files bigger than large_file_size are not buffered in memory, they are
+        read buffer_size bytes at a time while being written.
+
+        With volume_size, the output is split in independent zip files of
+        about that many bytes, named <zipfile>.1.zip, <zipfile>.2.zip, ...
+        after the first one. Files that can not be read are skipped, reported
+        on the standard error stream and kept in errors as (path, exception).
+        Errors opening or writing a volume stop the run.
+    """
+
+    def __init__(self, container, jobs=None, verbose=False, compress_level=zlib.Z_DEFAULT_COMPRESSION,
+                 large_file_size=64 * 1024 * 1024, volume_size=None, stored_extensions=compressed_media,
+                 buffer_size=4 * 1024 * 1024):
+        self.container = container
+        self.jobs = jobs or os.cpu_count() or 1
+        self.verbose = verbose
+        self.compress_level = compress_level
+        self.large_file_size = large_file_size
+        self.volume_size = volume_size
+        self.stored_extensions = frozenset(extension.lower() for extension in stored_extensions)
+        self.buffer_size = buffer_size
+        self.volume = 0
+        self.volumes = []
+        self.errors = []
+
+    def get_volume_path(self, volume):
+        """ Returns the path of the zip file of a volume, the container itself for the first one """
+        if not volume:
+            return self.container
+        base, extension = os.path.splitext(self.container)
+        return "{}.{}{}".format(base, volume, extension)
+
+    def __open_volume(self, volume):
+        """ Opens a volume, or the first next one that is not full yet """
+        while self.volume_size and os.path.exists(self.get_volume_path(volume)) \
+                and os.path.getsize(self.get_volume_path(volume)) >= self.volume_size:
+            volume += 1
+        archive = zipfile.ZipFile(self.get_volume_path(volume), "a")
+        self.volume = volume
+        self.volumes.append(archive.filename)
+        return archive
+
+    def __make_room(self, archive, size):
+        """ Opens the next volume and closes the current one if size more bytes do not fit in it """
+        if self.volume_size and archive.filelist and archive.start_dir + size > self.volume_size:
+            next_archive = self.__open_volume(self.volume + 1)
+            try:
+                archive.close()
+            except BaseException:
+                next_archive.close()
+                raise
+            return next_archive
+        return archive
+
+    def __get_compress_type(self, file_path):
+        if os.path.splitext(file_path)[1].lower() in self.stored_extensions:
+            return zipfile.ZIP_STORED
+        return zipfile.ZIP_DEFLATED
+
+    def __skip(self, file_path, os_error):
+        print("Skipped: {}".format(os_error), file=sys.stderr)
+        self.errors.append((file_path, os_error))
+        instrumentation.stats.count("files skipped")
+        return False
+
+    def __write_pending(self, archive, collected_file, future):
+        """ Writes the next entry in order, waiting for its worker if needed.
+            Returns the archive the next entry goes to and whether the file was written.
+            Errors reading the file skip it, errors writing the archive are raised """
+        file_path = collected_file.get_absolute_file_path()
+        try:
+            zip_info = zipfile.ZipInfo.from_file(file_path, collected_file.get_filename())
+            if future is None:
+                source = open(file_path, "rb")
+            else:
+                payload, zip_info.CRC, zip_info.file_size = future.result()
+        except OSError as os_error:
+            return archive, self.__skip(file_path, os_error)
+
+        zip_info.compress_type = self.__get_compress_type(file_path)
+        if future is None:
+            zip_info.CRC = 0
+            with source:
+                archive = self.__make_room(archive, zip_info.file_size)
+                read_error = write_zip_entry(archive, zip_info, read_chunks(source, zip_info, self.compress_level,
+                                                                            self.buffer_size))
+            if read_error:
+                return archive, self.__skip(file_path, read_error)
+            instrumentation.stats.count("bytes streamed", zip_info.file_size)
+        else:
+            zip_info.compress_size = len(payload)
+            archive = self.__make_room(archive, len(payload))
+            write_zip_entry(archive, zip_info, (payload,))
+
+        if self.verbose:
+            print("..." + file_path, file=sys.stdout)
+        return archive, True
+
+    def __submit(self, executor, file_path):
+        """ Starts compressing or reading a file on a worker, None for a large file """
+        try:
+            if os.path.getsize(file_path) > self.large_file_size:
+                return None
+        except OSError:
+            pass
+        if self.__get_compress_type(file_path) == zipfile.ZIP_STORED:
+            return executor.submit(read_file, file_path)
+        return executor.submit(deflate_file, file_path, self.compress_level)
+
+    def write(self, collected_files):
+        """
+            Compresses and appends every CollectedFile to the zip file.
+            At most twice as many files as workers are held in memory.
+
+            :param collected_files: an iterable of CollectedFile objects
+
+            returns: number of files appended
+        """
+        check_write_zip_entry()
+        appended = 0
+        pending = collections.deque()
+        with warnings.catch_warnings(), \
+                concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            warnings.simplefilter("ignore")
+            archive = self.__open_volume(0)
+            try:
+                for collected_file in collected_files:
+                    pending.append((collected_file, self.__submit(executor, collected_file.get_absolute_file_path())))
+
+                    while len(pending) > self.jobs * 2:
+                        archive, written = self.__write_pending(archive, *pending.popleft())
+                        appended += written
+
+                while pending:
+                    archive, written = self.__write_pending(archive, *pending.popleft())
+                    appended += written
+            finally:
+                archive.close()
+        return appended
+
+
+class FileMatcher:
+    """
+        Decides which file names are collected. Extensions are compiled into
+        a set of lowercase suffixes, so matching a name is a single set lookup
+        on its last suffix instead of scanning the whole extension tuple, and
+        only that suffix is lowercased. Bare extensions ('txt') are treated as
+        '.txt'. Multi-dot suffixes ('.tar.gz') and endings that are not a
+        suffix ('_final.pdf') are checked with str.endswith.
+
+        Files can also be included by glob or regex and excluded by regex.
+        With sniff, files whose suffix does not match are opened and their
+        first bytes compared against known signatures of the wanted formats.
+
+        matches(name, path=None) returns True if a file should be collected,
+        the path is only opened when sniffing.
+    """
+
+    # leading bytes of common formats and the extensions they are stored under
+    signatures = (
+        (0, b"\xff\xd8\xff", (".jpg", ".jpeg", ".jpe")),
+        (0, b"\x89PNG\r\n\x1a\n", (".png",)),
+        (0, b"GIF8", (".gif",)),
+        (0, b"BM", (".bmp",)),
+        (0, b"II*\x00", (".tif", ".tiff")),
+        (0, b"MM\x00*", (".tif", ".tiff")),
+        (0, b"%PDF", (".pdf",)),
+        (0, b"PK\x03\x04", (".docx", ".xlsx", ".odt")),
+        (0, b"\xd0\xcf\x11\xe0", (".doc", ".xls")),
+        (0, b"ID3", (".mp3",)),
+        (8, b"WAVE", (".wav",)),
+        (8, b"AVI ", (".avi",)),
+        (8, b"AIFF", (".aif", ".aiff")),
+        (4, b"ftyp", (".mp4", ".mov", ".qt")),
+        (0, b"\x00\x00\x01\xba", (".mpeg", ".mpg", ".mpe")),
+    )
+
+    suffix_pattern = re.compile(r"^\.?[a-z0-9]+(\.[a-z0-9]+)*$")
+
+    def __init__(self, file_extensions=(), includes=(), include_regexes=(), exclude_regexes=(), sniff=False):
+        self.suffixes = set()
+        endings = []
+        for extension in file_extensions:
+            extension = extension.lower()
+            if self.suffix_pattern.match(extension):
+                extension = extension if extension.startswith(".") else "." + extension
+                if extension.count(".") == 1:
+                    self.suffixes.add(extension)
+                    continue
+            if extension:
+                endings.append(extension)
+        self.endings = tuple(endings)
+
+        # globs must match the whole name, regexes match anywhere in it like the exclude ones
+        self.include = self.__join(fnmatch.translate(pattern) for pattern in includes)
+        self.include_regex = self.__join(include_regexes)
+        self.exclude = self.__join(exclude_regexes)
+        self.sniffed = tuple(signature for signature in self.signatures
+                             if self.suffixes.intersection(signature[2])) if sniff else ()
+        self.matches = self.__compile()
+
+    @staticmethod
+    def __join(patterns):
+        patterns = list(patterns)
+        return re.compile("|".join("(?:{})".format(p) for p in patterns)) if patterns else None
+
+    def __compile(self):
+        """ Builds the matches(name, path=None) function, skipping the rules that are not used """
+        suffixes = self.suffixes
+        endings = self.endings
+
+        if not (self.include or self.include_regex or self.exclude or self.sniffed):
+            if not endings:
+                return lambda name, path=None: name[name.rfind("."):].lower() in suffixes
+            return lambda name, path=None: (name[name.rfind("."):].lower() in suffixes
+                                            or name.lower().endswith(endings))
+
+        include = self.include.match if self.include else None
+        include_regex = self.include_regex.search if self.include_regex else None
+        exclude = self.exclude.search if self.exclude else None
+        sniff = self.__matches_content if self.sniffed else None
+
+        def matches(name, path=None):
+            if exclude and exclude(name):
+                return False
+            if name[name.rfind("."):].lower() in suffixes:
+                return True
+            if endings and name.lower().endswith(endings):
+                return True
+            if include and include(name):
+                return True
+            if include_regex and include_regex(name):
+                return True
+            return bool(sniff and path) and sniff(path)
+
+        return matches
+
+    def __matches_content(self, path):
+        try:
+            with open(path, "rb") as file_object:
+                head = file_object.read(16)
+        except OSError:
+            return False
+        return any(head.startswith(magic, offset) for offset, magic, _ in self.sniffed)
+
+
+def is_excluded(name, relative_path, excludes):
+    """ Returns True if an entry name or its path relative to the source directory matches an exclude glob """
+    return any(fnmatch.fnmatch(name, pattern) or fnmatch.fnmatch(relative_path, pattern) for pattern in excludes)
+
+
+def scan_directory(src, path, depth, matcher, max_depth=None, excludes=()):
+    """
+        Lists a single directory with os.scandir. The file type comes from the
+        directory entry itself, so no extra stat call is made per file.
+        Unreadable directories are skipped, like os.walk does.
+
+        :param src: source directory the walk started from
+        :param path: directory to be listed
+        :param depth: depth of path below src, src itself is depth 0
+        :param matcher: FileMatcher deciding which files are collected
+        :param max_depth: deepest directory level to descend into, None for no limit
+        :param excludes: glob patterns of file and directory names to leave out
+
+        returns: a (sorted CollectedFile list, sorted subdirectory path list) tuple
+    """
+    collected = []
+    subdirs = []
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if excludes and is_excluded(entry.name, os.path.relpath(entry.path, src), excludes):
+                    continue
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+                if is_dir:
+                    # like os.walk, symlinked directories are not followed
+                    if (max_depth is None or depth < max_depth) and not entry.is_symlink():
+                        subdirs.append(entry.path)
+                elif matcher.matches(entry.name, entry.path):
+                    collected.append(CollectedFile(entry.path, entry.name))
+    except OSError:
+        pass
+    collected.sort(key=CollectedFile.get_filename)
+    subdirs.sort()
+    return collected, subdirs
+
+
+def walk_files(src, matcher, jobs=1, max_depth=None, excludes=(), ordered=True, max_pending=None):
+    """
+        Walks through a source file tree listing directories on a pool of
+        threads, which hides the stat latency of network file systems.
+
+        When ordered, files are yielded depth first with every directory's
+        entries sorted by name, the same order whatever the number of jobs.
+        Otherwise files are yielded as soon as their directory is listed.
+
+        :param src: a source directory to collect files from
+        :param matcher: FileMatcher deciding which files are collected
+        :param jobs: number of threads listing directories
+        :param max_depth: deepest directory level to descend into, None for no limit
+        :param excludes: glob patterns of file and directory names to leave out
+        :param ordered: yields files in a deterministic order
+        :param max_pending: most directory listings queued at once (default: jobs * 4)
+
+        yields: CollectedFile object
+    """
+    max_pending = max_pending or jobs * 4
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        def submit(path, depth):
+            return executor.submit(scan_directory, src, path, depth, matcher, max_depth, excludes)
+
+        if ordered:
+            # stack of [path, depth, future], the top listings are prefetched
+            stack = [[src, 0, submit(src, 0)]]
+            in_flight = 1
+            while stack:
+                path, depth, future = stack.pop()
+                if future is None:
+                    future = submit(path, depth)
+                else:
+                    in_flight -= 1
+                collected, subdirs = future.result()
+                yield from collected
+
+                stack.extend([subdir, depth + 1, None] for subdir in reversed(subdirs))
+                for entry in reversed(stack[-max_pending:]):
+                    if in_flight >= max_pending:
+                        break
+                    if entry[2] is None:
+                        entry[2] = submit(entry[0], entry[1])
+                        in_flight += 1
         else:
-            if verbose:
-                print("..." + file, file=sys.stdout)
+            waiting = collections.deque()
+            running = {submit(src, 0): 0}
+            while running:
+                done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    depth = running.pop(future)
+                    collected, subdirs = future.result()
+                    yield from collected
+                    waiting.extend((subdir, depth + 1) for subdir in subdirs)
+                while waiting and len(running) < max_pending:
+                    path, depth = waiting.popleft()
+                    running[submit(path, depth)] = depth
+
 
+def hash_file(file_path, chunk_size=1024 * 1024):
+    """ Returns the sha256 hex digest of a file's content, read chunk_size bytes at a time
+        into a reused buffer. Not memory mapped: a file truncated while it is hashed would
+        kill the process with SIGBUS instead of raising an error """
+    digest = hashlib.sha256()
+    buffer = bytearray(chunk_size)
+    with instrumentation.stats.stage("hash"), open(file_path, "rb") as file_object, memoryview(buffer) as view:
+        for read in iter(lambda: file_object.readinto(buffer), 0):
+            digest.update(view[:read])
+            instrumentation.stats.count("bytes hashed", read)
+    return digest.hexdigest()
 
-def collect_files(src, file_extensions):
+
+class Deduplicator:
+    """
+        Finds byte-identical files so only one copy of each payload is
+        compressed. Files are grouped by size first and only files sharing a
+        size are hashed. Duplicates are recorded in a JSON lines manifest next
+        to the zip file ('<zipfile>.dedup.jsonl') and can also be stored as
+        symbolic link entries pointing to the first copy, which cost a few
+        bytes each.
+    """
+
+    def __init__(self, jobs=1):
+        self.jobs = jobs
+        self.duplicates = []
+
+    def filter_unique(self, collected_files):
+        """
+            Yields the first CollectedFile of every distinct content, in the
+            order they were collected. All files are collected and grouped
+            before the first one is yielded.
+
+            :param collected_files: an iterable of CollectedFile objects
+
+            yields: CollectedFile object
+        """
+        sizes = collections.defaultdict(list)
+        collected = []
+        for collected_file in collected_files:
+            try:
+                size = os.path.getsize(collected_file.get_absolute_file_path())
+            except OSError:
+                size = None
+            collected.append((collected_file, size))
+            if size is not None:
+                sizes[size].append(collected_file)
+
+        candidates = [collected_file for group in sizes.values() if len(group) > 1 for collected_file in group]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            digests = dict(zip(candidates, executor.map(self.__hash, candidates)))
+
+        originals = {}
+        for collected_file, size in collected:
+            digest = digests.get(collected_file)
+            if digest is None:
+                yield collected_file
+                continue
+            original = originals.setdefault((size, digest), collected_file)
+            if original is collected_file:
+                yield collected_file
+            else:
+                self.duplicates.append((collected_file, original))
+
+    @staticmethod
+    def __hash(collected_file):
+        try:
+            return hash_file(collected_file.get_absolute_file_path())
+        except OSError:
+            return None
+
+    def write_manifest(self, container):
+        """ Appends the duplicates found to '<zipfile>.dedup.jsonl' """
+        with open(container + ".dedup.jsonl", "a") as manifest:
+            for duplicate, original in self.duplicates:
+                manifest.write(json.dumps({
+                    "path": duplicate.get_absolute_file_path(),
+                    "arcname": duplicate.get_filename(),
+                    "duplicate_of": original.get_absolute_file_path(),
+                    "duplicate_of_arcname": original.get_filename(),
+                }) + "\n")
+
+    def write_links(self, container):
+        """
+            Stores every duplicate as a symbolic link entry to the archive name
+            of its original. Duplicates sharing the original's archive name
+            are only recorded in the manifest.
+        """
+        with warnings.catch_warnings(), zipfile.ZipFile(container, "a") as archive:
+            warnings.simplefilter("ignore")
+            for duplicate, original in self.duplicates:
+                if duplicate.get_filename() == original.get_filename():
+                    continue
+                zip_info = zipfile.ZipInfo(duplicate.get_filename(), time.localtime()[:6])
+                zip_info.create_system = 3
+                zip_info.external_attr = (stat.S_IFLNK | 0o777) << 16
+                archive.writestr(zip_info, original.get_filename())
+
+
+class FileIndex:
+    """
+        Persistent SQLite index of the files stored in a zip file, kept next
+        to it as '<zipfile>.idx'. Each indexed file keeps its size, mtime and
+        optionally a sha256 of its content, so later runs only append files
+        that are new or changed. Files that disappeared from the source are
+        not removed from the zip file, they are tombstoned in the index.
+    """
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS files (
+            path TEXT PRIMARY KEY,
+            arcname TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            sha256 TEXT,
+            deleted INTEGER NOT NULL DEFAULT 0,
+            updated_at REAL NOT NULL
+        )
+    """
+
+    def __init__(self, container, use_hash=False):
+        self.index_path = container + ".idx"
+        self.use_hash = use_hash
+        self.connection = sqlite3.connect(self.index_path)
+        self.connection.execute(self.schema)
+        self.known = {row[0]: row[1:] for row in self.connection.execute(
+            "SELECT path, size, mtime_ns, sha256 FROM files WHERE deleted = 0")}
+        self.pending = []
+        self.seen = set()
+        self.tombstoned = 0
+
+    def filter_changed(self, collected_files):
+        """
+            Yields only the CollectedFile objects that are not in the index or
+            whose size or mtime changed. With use_hash, a file whose size or
+            mtime changed but whose content did not is not yielded again.
+            Index updates are held until commit() is called.
+
+            :param collected_files: an iterable of CollectedFile objects
+
+            yields: CollectedFile object
+        """
+        for collected_file in collected_files:
+            path = os.path.abspath(collected_file.get_absolute_file_path())
+            try:
+                file_stat = os.stat(path)
+            except OSError:
+                continue
+            self.seen.add(path)
+
+            known = self.known.get(path)
+            if known and known[0] == file_stat.st_size and known[1] == file_stat.st_mtime_ns:
+                continue
+
+            sha256 = hash_file(path) if self.use_hash else None
+            self.pending.append((path, collected_file.get_filename(), file_stat.st_size, file_stat.st_mtime_ns,
+                                 sha256))
+            if known and sha256 and known[2] == sha256:
+                continue
+            yield collected_file
+
+    def discard(self, file_paths):
+        """
+            Leaves files that could not be archived out of the next commit,
+            so the next run tries them again.
+
+            :param file_paths: paths of the files to leave out
+        """
+        discarded = {os.path.abspath(file_path) for file_path in file_paths}
+        self.pending = [entry for entry in self.pending if entry[0] not in discarded]
+
+    def commit(self, source):
+        """
+            Stores the new and changed files and tombstones the indexed files
+            under the source directory that were not seen during the run.
+
+            :param source: source directory that was collected
+        """
+        now = time.time()
+        prefix = os.path.join(os.path.abspath(source), "")
+        deleted = [(now, path) for path in self.known if path.startswith(prefix) and path not in self.seen]
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO files (path, arcname, size, mtime_ns, sha256, deleted, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, 0, ?)", (entry + (now,) for entry in self.pending))
+            self.connection.executemany("UPDATE files SET deleted = 1, updated_at = ? WHERE path = ?", deleted)
+        self.tombstoned = len(deleted)
+
+    def close(self):
+        self.connection.close()
+
+
+def collect_files(src, file_extensions, jobs=1, max_depth=None, excludes=(), ordered=True, matcher=None):
     """
         Walks through source file tree and yields a CollectedFile object
         that meets the file extensions criteria. If source directory does
@@ -87,6 +853,11 @@ def collect_files(src, file_extensions):
         Params:
         :param src: a source directory to collect files from
         :param file_extensions: a tuple of file extensions (.txt, .xls, .jpeg)
+        :param jobs: number of threads listing directories
+        :param max_depth: deepest directory level to descend into, None for no limit
+        :param excludes: glob patterns of file and directory names to leave out
+        :param ordered: yields files in a deterministic order
+        :param matcher: FileMatcher used instead of one built from file_extensions
 
         yields: CollectedFile object
     """
@@ -96,10 +867,8 @@ def collect_files(src, file_extensions):
     if not isinstance(file_extensions, tuple):
         raise TypeError()
     else:
-        for path, dirs, files in os.walk(src):
-            for file in files:
-                if file.lower().endswith(file_extensions):
-                    yield CollectedFile(os.path.join(path, file))
+        yield from walk_files(src, matcher or FileMatcher(file_extensions), jobs=jobs, max_depth=max_depth,
+                              excludes=tuple(excludes), ordered=ordered)
 
 
 def main():
@@ -110,12 +879,48 @@ def main():
                               action="store_true", default=False)
     flags_parser.add_argument("--media", "-m", help="includes most commom media file extensions to the search criteria",
                               action="store_true", default=False)
+    flags_parser.add_argument("--stream", "-s", help="opens the zipfile once and deflates files on a pool of workers",
+                              action="store_true", default=False)
+    flags_parser.add_argument("--volume-size", help="with --stream, splits the zipfile in volumes of about this "
+                                                    "many megabytes", type=int, default=None)
+    flags_parser.add_argument("--jobs", "-j", help="number of compression workers used by --stream and of "
+                                                   "hashing threads used by --dedup (default: number of CPUs)",
+                              type=int, default=None)
+    flags_parser.add_argument("--walkers", "-w", help="number of threads walking the source directory tree",
+                              type=int, default=1)
+    flags_parser.add_argument("--max-depth", help="deepest directory level to descend into", type=int, default=None)
+    flags_parser.add_argument("--exclude", "-x", help="glob pattern of file or directory names to leave out, "
+                                                      "can be repeated", action="append", default=[])
+    flags_parser.add_argument("--unordered", help="collects files as soon as they are found instead of in a "
+                                                  "deterministic order", action="store_true", default=False)
+    flags_parser.add_argument("--incremental", "-i", help="only appends files that are new or changed since the "
+                                                          "previous run, tracked in '<zipfile>.idx'",
+                              action="store_true", default=False)
+    flags_parser.add_argument("--hash", help="with --incremental, compares file contents by sha256 when the size or "
+                                             "modification time changed", action="store_true", default=False)
+    flags_parser.add_argument("--dedup", help="stores byte-identical files once, duplicates are listed in "
+                                              "'<zipfile>.dedup.jsonl' and, with 'link', stored as symbolic links",
+                              choices=["manifest", "link"], nargs="?", const="manifest", default=None)
+    flags_parser.add_argument("--include", help="glob pattern of file names to collect whatever their extension, "
+                                                "can be repeated", action="append", default=[])
+    flags_parser.add_argument("--include-regex", help="regex matching file names to collect, can be repeated",
+                              action="append", default=[])
+    flags_parser.add_argument("--exclude-regex", help="regex matching file names to leave out, can be repeated",
+                              action="append", default=[])
+    flags_parser.add_argument("--sniff", help="collects files with an unmatched extension when their content "
+                                              "starts like one of the wanted formats", action="store_true",
+                              default=False)
+    instrumentation.add_arguments(flags_parser)
     flags_parser.add_argument("zipfile", help="/path/to/my_file.zip ", type=str)
     flags_parser.add_argument("extensions", help="file extensions to be added to the search criteria ex: txt pdf jpeg"
                                                  "png wav", type=tuple, nargs="*")
 
     # Arguments
     arguments = flags_parser.parse_args()
+    if arguments.volume_size and not arguments.stream:
+        flags_parser.error("--volume-size needs --stream")
+    if arguments.volume_size and arguments.dedup == "link":
+        flags_parser.error("--dedup link can not be used with --volume-size")
     source = arguments.source
     is_verbose = arguments.verbose
     zip_file_path_container = arguments.zipfile
@@ -128,8 +933,69 @@ def main():
     else:
         all_extensions = tuple(["".join(ext) for ext in arguments.extensions])
 
-    for collected_file in collect_files(source, all_extensions):
-        append_to_zipfile(zip_file_path_container, collected_file.get_absolute_file_path(), is_verbose)
+    try:
+        matcher = FileMatcher(all_extensions, includes=arguments.include, include_regexes=arguments.include_regex,
+                              exclude_regexes=arguments.exclude_regex, sniff=arguments.sniff)
+    except re.error as re_error:
+        print("Regex error: {}".format(re_error), file=sys.stderr)
+        sys.exit(1)
+
+    with instrumentation.session(arguments.stats, arguments.profile):
+        collected_files = collect_files(source, all_extensions, jobs=arguments.walkers, max_depth=arguments.max_depth,
+                                        excludes=arguments.exclude, ordered=not arguments.unordered, matcher=matcher)
+        collected_files = instrumentation.stats.iterate("walk", collected_files)
+
+        file_index = None
+        if arguments.incremental:
+            file_index = FileIndex(zip_file_path_container, use_hash=arguments.hash)
+            collected_files = instrumentation.stats.iterate("index", file_index.filter_changed(collected_files))
+
+        deduplicator = None
+        if arguments.dedup:
+            deduplicator = Deduplicator(jobs=arguments.jobs or os.cpu_count() or 1)
+            collected_files = instrumentation.stats.iterate("dedup", deduplicator.filter_unique(collected_files))
+
+        skipped = []
+        with instrumentation.stats.stage("archive"):
+            try:
+                check_write_zip_entry()
+            except RuntimeError as runtime_error:
+                print(runtime_error, file=sys.stderr)
+                sys.exit(1)
+            if arguments.stream:
+                writer = ZipStreamWriter(zip_file_path_container, jobs=arguments.jobs, verbose=is_verbose,
+                                         volume_size=arguments.volume_size and arguments.volume_size * 1024 * 1024)
+                try:
+                    instrumentation.stats.count("files archived", writer.write(collected_files))
+                except (OSError, zipfile.LargeZipFile) as archive_error:
+                    print("Archive error: {}".format(archive_error), file=sys.stderr)
+                    sys.exit(1)
+                skipped = [file_path for file_path, _ in writer.errors]
+                if is_verbose and len(writer.volumes) > 1:
+                    print("{} volumes: {}".format(len(writer.volumes), ", ".join(writer.volumes)))
+            else:
+                for collected_file in collected_files:
+                    if append_to_zipfile(zip_file_path_container, collected_file, is_verbose):
+                        instrumentation.stats.count("files archived")
+                    else:
+                        skipped.append(collected_file.get_absolute_file_path())
+        if skipped:
+            print("{} files could not be read and were skipped".format(len(skipped)), file=sys.stderr)
+
+        if deduplicator:
+            deduplicator.write_manifest(zip_file_path_container)
+            if arguments.dedup == "link":
+                deduplicator.write_links(zip_file_path_container)
+            if is_verbose:
+                print("{} duplicated files".format(len(deduplicator.duplicates)))
+
+        if file_index:
+            file_index.discard(skipped)
+            file_index.commit(source)
+            file_index.close()
+            if is_verbose:
+                print("{} new or changed files, {} deleted files".format(len(file_index.pending),
+                                                                       file_index.tombstoned))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,182 @@
+"""
+    Lightweight instrumentation shared by the tools of this repository:
+    per-stage timers, item and byte counters and optional cProfile dumps,
+    enabled with the --stats and --profile flags of every tool.
+
+    Copyright (C) 2017 rafael valera
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import cProfile
+import collections
+import contextlib
+import functools
+import sys
+import threading
+import time
+
+
+class StageTimer:
+    """ Times one run of a stage, minus the time of the stages nested in it """
+
+    __slots__ = ("stats", "name", "stack", "start", "inner")
+
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+
+    def __enter__(self):
+        self.stack = self.stats.get_stack()
+        self.stack.append(self)
+        self.inner = 0.0
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        elapsed = time.perf_counter() - self.start
+        self.stack.pop()
+        if self.stack:
+            self.stack[-1].inner += elapsed
+        self.stats.add_time(self.name, elapsed - self.inner)
+
+
+class Stats:
+    """ Per-stage timers and counters. Stages can be nested, every stage is timed
+        without the stages run inside it. Each thread keeps its own stack of stages,
+        so the stage times of worker threads can add up to more than the wall clock
+        time of a run. While disabled, stage(), iterate() and count() do nothing """
+
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.times = collections.defaultdict(float)
+            self.calls = collections.Counter()
+            self.counters = collections.Counter()
+            self.started = time.perf_counter()
+
+    def get_stack(self):
+        try:
+            return self.local.stack
+        except AttributeError:
+            self.local.stack = []
+            return self.local.stack
+
+    def add_time(self, name, seconds):
+        with self.lock:
+            self.times[name] += seconds
+            self.calls[name] += 1
+
+    def stage(self, name):
+        """ Returns a context manager timing the code run inside it as the stage name """
+        if not self.enabled:
+            return contextlib.nullcontext()
+        return StageTimer(self, name)
+
+    def timed(self, name):
+        """ Decorator timing every call of a function as the stage name """
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return function(*args, **kwargs)
+                with StageTimer(self, name):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def iterate(self, name, iterable):
+        """ Wraps an iterable so the time spent producing its items is timed as the
+            stage name, and the items are counted as '<name> items' """
+        if not self.enabled:
+            return iterable
+        return self.__iterate(name, iterable)
+
+    def __iterate(self, name, iterable):
+        iterator = iter(iterable)
+        items = name + " items"
+        while True:
+            with StageTimer(self, name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            self.count(items)
+            yield item
+
+    def count(self, name, amount=1):
+        """ Adds amount to the counter name, such as a number of files or bytes """
+        if self.enabled:
+            with self.lock:
+                self.counters[name] += amount
+
+    def report(self, stream=sys.stderr):
+        """ Prints the time and calls of every stage and the counters with their rate per second """
+        elapsed = time.perf_counter() - self.started
+        print("{:<24} {:>10} {:>12} {:>8}".format("stage", "calls", "seconds", "%"), file=stream)
+        for name, seconds in sorted(self.times.items(), key=lambda item: item[1], reverse=True):
+            print("{:<24} {:>10} {:>12.3f} {:>7.1f}%".format(name, self.calls[name], seconds,
+                                                            100.0 * seconds / elapsed if elapsed else 0),
+                  file=stream)
+        for name, value in sorted(self.counters.items()):
+            print("{:<24} {:>10} {:>12}/s".format(name, value, format_rate(value / elapsed if elapsed else 0)),
+                  file=stream)
+        print("{:<24} {:>10} {:>12.3f}".format("wall clock", "", elapsed), file=stream)
+
+
+def format_rate(rate):
+    """ Formats a rate with a K, M or G suffix """
+    for unit in ("", "K", "M"):
+        if rate < 1000:
+            return "{:.1f}{}".format(rate, unit)
+        rate /= 1000.0
+    return "{:.1f}G".format(rate)
+
+
+# the stats every tool records its stages and counters in
+stats = Stats()
+
+
+def add_arguments(parser):
+    """ Adds the --stats and --profile flags to the argparse parser of a tool """
+    parser.add_argument("--stats", help="prints the time spent in every stage and the item and byte counters to "
+                                        "the standard error stream when done", action="store_true", default=False)
+    parser.add_argument("--profile", help="writes cProfile statistics of the main thread to this file, readable "
+                                          "with 'python3 -m pstats'", metavar="FILE", type=str, default=None)
+
+
+@contextlib.contextmanager
+def session(enable_stats=False, profile_file=None):
+    """ Records the shared stats, and a cProfile profile if profile_file is given, while the
+        block runs. The stats are reported and the profile dumped when it ends, also when it
+        ends through sys.exit """
+    stats.reset()
+    stats.enabled = enable_stats
+    profiler = cProfile.Profile() if profile_file else None
+    if profiler:
+        profiler.enable()
+    try:
+        yield stats
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(profile_file)
+        if enable_stats:
+            stats.report()
+        stats.enabled = False
@@ -19,23 +19,64 @@
     along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+import argparse
 import bs4
+import collections
+import concurrent.futures
+import contextlib
+import hashlib
+import importlib.util
+import json
+import os
 import re
 import datetime
 import textwrap
-import urllib.request
-import urllib.error
+import threading
+import time
+import types
+import urllib.parse
 import sys
 
+import requests
+import requests.adapters
+import urllib3.util.retry
+
+try:
+    import lxml
+except ImportError:
+    lxml = None
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# --stats and --profile come from instrumentation.py at the root of the repository. It is loaded by
+# path so the tool runs from any directory, a copy of the tool on its own runs without the two flags
+try:
+    instrumentation_spec = importlib.util.spec_from_file_location("instrumentation", os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), os.pardir, "instrumentation.py"))
+    instrumentation = importlib.util.module_from_spec(instrumentation_spec)
+    instrumentation_spec.loader.exec_module(instrumentation)
+except FileNotFoundError:
+    instrumentation = types.SimpleNamespace(
+        stats=types.SimpleNamespace(stage=lambda name: contextlib.nullcontext(), count=lambda name, amount=1: None,
+                                    iterate=lambda name, iterable: iterable),
+        add_arguments=lambda parser: parser.set_defaults(stats=False, profile=None),
+        session=lambda enable_stats=False, profile_file=None: contextlib.nullcontext())
+
 
 class NewsEvent:
-    """ A simple model class of a news event """
+    """ A simple model class of a news event. Its content is kept as a list of
+        paragraphs and only wrapped into text when it is displayed """
 
     def __init__(self, **kwargs):
         self.headline = kwargs["headline"]
         self.link = kwargs["link"]
         self.date = kwargs["date"]
-        self.content = kwargs["content"]
+        self.paragraphs = kwargs.get("paragraphs") or [paragraph for paragraph
+                                                       in kwargs.get("content", "").split("\n\n") if paragraph]
         self.author = ""
         self.location = ""
 
@@ -45,8 +86,26 @@ class NewsEvent:
     def get_date(self):
         return self.date
 
-    def get_content(self):
-        return self.content
+    def get_paragraphs(self):
+        return self.paragraphs
+
+    def iter_content(self, width=100):
+        """ Yields the paragraphs one at a time, wrapped at width columns """
+        for paragraph in self.paragraphs:
+            yield "\n".join(textwrap.wrap(paragraph, width)) + "\n\n"
+
+    def get_content(self, width=100):
+        return "".join(self.iter_content(width))
+
+    @property
+    def content(self):
+        return self.get_content()
+
+    def to_dict(self):
+        """ Returns the news event as a dictionary of JSON serializable values """
+        return {"headline": self.headline, "link": self.link,
+                "date": self.date.isoformat() if self.date else None,
+                "paragraphs": self.paragraphs, "author": self.author, "location": self.location}
 
     def __str__(self):
         try:
@@ -55,6 +114,10 @@ class NewsEvent:
             return "<NewsEvent {} {} >".format(None, self.headline)
 
 
+class ScrapingError(Exception):
+    """ Raised when a page can not be retrieved or is not what was expected """
+
+
 class SoupMaker:
     """ BeautifulSoup object maker """
 
@@ -63,41 +126,172 @@ class SoupMaker:
                       "(KHTML, like Gecko) Chrome/41.0.2227.0 Safari/537.36",
         "Content-Type": "application/x-www-form-urlencoded;charset=utf-8",
         "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8",
-        "Accept_Language": "nl-NL,nl;q=0.8,en-US;q=0.6,en;q=0.4",
-        "Accept_Encoding": "gzip, deflate, sdch",
+        "Accept-Language": "nl-NL,nl;q=0.8,en-US;q=0.6,en;q=0.4",
+        "Accept-Encoding": "gzip, deflate",
         "Connection": "keep-alive",
     }
 
+    # connect and read timeouts in seconds
+    timeout = (3.05, 15)
+    # keep-alive connections kept open per host
+    pool_size = 16
+    # retries of failed connections and 429/5xx responses, waiting backoff_factor * 2 ** retry seconds
+    retries = 3
+    backoff_factor = 0.5
+
+    session = None
+    session_lock = threading.Lock()
+
     @classmethod
-    def http_get_request(cls, url):
-        """ Sends an GET http request and returns the response as string object """
+    def get_session(cls):
+        """ Returns the requests session shared by every request, so connections are reused """
+        with cls.session_lock:
+            if cls.session is None:
+                retry = urllib3.util.retry.Retry(total=cls.retries, backoff_factor=cls.backoff_factor,
+                                                 status_forcelist=(429, 500, 502, 503, 504),
+                                                 allowed_methods=frozenset(["GET"]))
+                adapter = requests.adapters.HTTPAdapter(pool_connections=cls.pool_size, pool_maxsize=cls.pool_size,
+                                                        max_retries=retry)
+                session = requests.Session()
+                session.headers.update(cls.headers)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                cls.session = session
+            return cls.session
+
+    # PageCache used for conditional requests, None to always download pages
+    page_cache = None
+
+    # tree builder of BeautifulSoup, the C based lxml parser when it is installed
+    parser = "lxml" if lxml else "html.parser"
 
+    @staticmethod
+    def decode(response):
+        """ Decodes a response body with the charset of its Content-Type header, utf-8 if it has none.
+            gzip and deflate bodies are already decompressed by requests """
+        charset = re.search(r"charset=[\"']?([\w.:-]+)", response.headers.get("Content-Type", ""), re.I)
         try:
-            request = urllib.request.Request(url, headers=cls.headers)
-            response = urllib.request.urlopen(request)
-        except urllib.error.HTTPError as http_error:
-            print("Connection error: ", http_error)
-            sys.exit(1)
-        except urllib.error.URLError as url_error:
-            print("URL error :", url_error)
-            sys.exit(1)
-        else:
-            if response.reason == "OK" and response.status == 200:
-                return response.read().decode("utf-8")
+            return response.content.decode(charset.group(1) if charset else "utf-8", errors="replace")
+        except LookupError:
+            return response.content.decode("utf-8", errors="replace")
+
+    @classmethod
+    def __get(cls, url, headers=None):
+        try:
+            with instrumentation.stats.stage("http"):
+                return cls.get_session().get(url, timeout=cls.timeout, headers=headers)
+        except requests.RequestException as request_error:
+            raise ScrapingError("Connection error: {}".format(request_error)) from request_error
+
+    @classmethod
+    def fetch(cls, url):
+        """ Sends a GET http request and returns a (page string, not modified) tuple. With a
+            page cache, the request is conditional and a page that did not change is read
+            from the cache. Raises a ScrapingError if the page can not be retrieved """
+        cached = cls.page_cache.get(url) if cls.page_cache else None
+        headers = {}
+        if cached:
+            if cached.get("etag"):
+                headers["If-None-Match"] = cached["etag"]
+            if cached.get("last_modified"):
+                headers["If-Modified-Since"] = cached["last_modified"]
+
+        response = cls.__get(url, headers)
+        if response.status_code == 304 and cached:
+            try:
+                page = cls.page_cache.get_page(url)
+            except OSError:
+                # the cached copy was removed from the cache directory, the page is downloaded again
+                response = cls.__get(url)
             else:
-                exception = "Bad http response. Status: {} Reason: {}".format(response.status, response.reason)
-                print(exception)
-                sys.exit(1)
+                instrumentation.stats.count("pages not modified")
+                return page, True
+        if response.status_code == 200:
+            instrumentation.stats.count("response bytes", len(response.content))
+            page = cls.decode(response)
+            if cls.page_cache:
+                cls.page_cache.store(url, page, response.headers.get("ETag"), response.headers.get("Last-Modified"))
+            return page, False
+        else:
+            raise ScrapingError("Bad http response. Status: {} Reason: {}".format(response.status_code,
+                                                                                  response.reason))
 
     @classmethod
-    def make_soup(cls, url):
-        """Constructs a BeautifulSoup object from a url"""
-        response = cls.http_get_request(url)
+    def http_get_request(cls, url):
+        """ Sends an GET http request and returns the response as string object.
+            Raises a ScrapingError if the page can not be retrieved """
+        return cls.fetch(url)[0]
+
+    @classmethod
+    def make_soup(cls, url, parse_only=None):
+        """Constructs a BeautifulSoup object from a url. With a SoupStrainer as parse_only,
+           only the matching elements are built into the soup. A page that was not modified
+           since it was last parsed reuses its soup from the page cache"""
+        response, not_modified = cls.fetch(url)
         if not response:
-            print("Connection Error: Unable to retrieve URL resource")
-            sys.exit(1)
-        else:
-            return bs4.BeautifulSoup(response, "html.parser")
+            raise ScrapingError("Connection Error: Unable to retrieve URL resource")
+        if not_modified:
+            soup = cls.page_cache.get_soup(url, parse_only)
+            if soup is not None:
+                return soup
+        with instrumentation.stats.stage("parse"):
+            soup = bs4.BeautifulSoup(response, cls.parser, parse_only=parse_only)
+        if cls.page_cache:
+            cls.page_cache.store_soup(url, soup, parse_only)
+        return soup
+
+
+class PageCache:
+    """ On disk cache of pages keyed by url, stored with their ETag and Last-Modified
+        validators so pages can be requested conditionally. The soups of the last
+        max_soups parsed pages are also kept in memory """
+
+    def __init__(self, directory, max_soups=32):
+        self.directory = directory
+        self.max_soups = max_soups
+        self.soups = collections.OrderedDict()
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def __path(self, url, extension):
+        return os.path.join(self.directory, hashlib.sha1(url.encode("utf-8")).hexdigest() + extension)
+
+    def get(self, url):
+        """ Returns the validators of a cached url as a dictionary, None if it is not cached """
+        try:
+            with open(self.__path(url, ".json")) as meta_file:
+                return json.load(meta_file)
+        except (IOError, ValueError):
+            return None
+
+    def get_page(self, url):
+        with open(self.__path(url, ".html"), encoding="utf-8") as page_file:
+            return page_file.read()
+
+    def store(self, url, page, etag=None, last_modified=None):
+        """ Stores a page if the server sent a validator for it """
+        if not etag and not last_modified:
+            return
+        with open(self.__path(url, ".html"), "w", encoding="utf-8") as page_file:
+            page_file.write(page)
+        with open(self.__path(url, ".json"), "w") as meta_file:
+            json.dump({"url": url, "etag": etag, "last_modified": last_modified}, meta_file)
+        with self.lock:
+            self.soups.pop(url, None)
+
+    def get_soup(self, url, parse_only=None):
+        with self.lock:
+            return self.soups.get(url, {}).get(parse_only)
+
+    def store_soup(self, url, soup, parse_only=None):
+        """ Keeps the soup of a cached page in memory, one per SoupStrainer it was parsed with """
+        if not os.path.exists(self.__path(url, ".json")):
+            return
+        with self.lock:
+            self.soups.setdefault(url, {})[parse_only] = soup
+            self.soups.move_to_end(url)
+            while len(self.soups) > self.max_soups:
+                self.soups.popitem(last=False)
 
 
 class HetNieuwsblad:
@@ -111,22 +305,28 @@ class HetNieuwsblad:
     MAIN_PAGE_SHE = "http://www.nieuwsblad.be/she"
     NEWS_CONTENT_EXAMPLE = "http://www.nieuwsblad.be/cnt/dmf20170423_02846625"
 
+    # only the headline anchors of a main page are built into its soup
+    HEADLINES_STRAINER = bs4.SoupStrainer("a", class_=re.compile(r"(^|\s)link-complex(\s|$)"))
+
+    HEADLINE_DATETIME_REGEX = re.compile(r"http://www\.nieuwsblad\.be/cnt/dmf(?P<date>\d+)_\d+", re.I)
+
     @staticmethod
     def get_headlines(main_page_url):
         """ Retrieves HetNieuwsblad headlines on the site main pages.
             If an AttributeError or KeyError is raised, it yields nothing. """
 
-        # creates a beautifulSoup object
-        soup = SoupMaker.make_soup(main_page_url)
+        # creates a beautifulSoup object of the headline anchors
+        soup = SoupMaker.make_soup(main_page_url, HetNieuwsblad.HEADLINES_STRAINER)
 
         # from each anchor element, retrieve headline, datetime,
         for anchor_element in soup.find_all("a", class_="link-complex"):
             try:
                 headline_link = anchor_element["href"]
                 date_time = HetNieuwsblad.__parse_headline_datetime(headline_link)
-                headline = anchor_element.find_next("h1").string
+                headline = anchor_element.find("h1").string
                 headline = headline.strip()
-                headline_link = headline_link.strip()
+                # teasers often link relative to the main page
+                headline_link = urllib.parse.urljoin(main_page_url, headline_link.strip())
             except AttributeError:
                 pass
             except KeyError:
@@ -146,28 +346,22 @@ class HetNieuwsblad:
             headline = soup.find("h1", {"itemprop": "name"}).string
             div_element_article_body = soup.find("div", class_="article__body")
 
-            # constructs content NewsEvent content from all paragraphs found in the div element
-            content = ""
-            for p_element in div_element_article_body.find_all_next("p"):
-                content += "\n".join(textwrap.wrap(p_element.text, 100)) + "\n\n"
+            # NewsEvent content is made of all paragraphs found in the div element
+            paragraphs = [p_element.text for p_element in div_element_article_body.find_all("p")]
 
             datetime_string = soup.find("time", {"itemprop": "datePublished"})["datetime"]
             datetime_object = datetime.datetime.strptime(datetime_string, "%Y-%m-%d %H:%M+02:00")
-        except AttributeError:
-            print("Content error: not a http://www.nieuwsblad.be news content url")
-            sys.exit(1)
+        except (AttributeError, KeyError, TypeError, ValueError):
+            raise ScrapingError("Content error: not a http://www.nieuwsblad.be news content url: {}".format(url))
         else:
-            return NewsEvent(headline=headline, link=url, date=datetime_object, content=content)
+            return NewsEvent(headline=headline, link=url, date=datetime_object, paragraphs=paragraphs)
 
     @staticmethod
     def __parse_headline_datetime(headline_url):
         """ Fetches a datetime string from HetNieuwsblad url and returns a datetime object
             if it can't retrieve the datetime it returns epoch timestamp 0 """
 
-        regex = "http://www.nieuwsblad.be/cnt/dmf(?P<date>\d+)_\d+"
-        pattern = re.compile(regex, re.I)
-
-        match = re.search(pattern, headline_url)
+        match = HetNieuwsblad.HEADLINE_DATETIME_REGEX.search(headline_url)
         if match:
             datetime_string = match.group("date")
             datetime_object = datetime.datetime.strptime(datetime_string, "%Y%m%d")
@@ -176,13 +370,235 @@ class HetNieuwsblad:
             return None
 
 
+class NewsEventWriter:
+    """ Streams NewsEvent objects to a JSON Lines file, one event per line, or to a
+        Parquet file when pyarrow is installed. Parquet rows are written in row groups
+        of batch_size events, so only one batch is held in memory """
+
+    formats = ("jsonl", "parquet")
+
+    def __init__(self, output_file, output_format=None, batch_size=1000):
+        if output_format is None:
+            output_format = "parquet" if output_file.endswith(".parquet") else "jsonl"
+        if output_format not in self.formats:
+            raise ValueError("unknown export format: {}".format(output_format))
+        if output_format == "parquet" and pyarrow is None:
+            raise ValueError("parquet export needs the pyarrow package")
+        self.output_file = output_file
+        self.output_format = output_format
+        self.batch_size = batch_size
+        self.batch = []
+        self.count = 0
+        if output_format == "parquet":
+            schema = pyarrow.schema([("headline", pyarrow.string()), ("link", pyarrow.string()),
+                                     ("date", pyarrow.timestamp("s")), ("paragraphs", pyarrow.list_(pyarrow.string())),
+                                     ("author", pyarrow.string()), ("location", pyarrow.string())])
+            self.stream = pyarrow.parquet.ParquetWriter(output_file, schema)
+        else:
+            self.stream = open(output_file, "a", encoding="utf-8")
+
+    def write(self, news_event):
+        if self.output_format == "jsonl":
+            self.stream.write(json.dumps(news_event.to_dict(), ensure_ascii=False) + "\n")
+        else:
+            self.batch.append(news_event)
+            if len(self.batch) >= self.batch_size:
+                self.flush()
+        self.count += 1
+
+    def write_all(self, news_events):
+        """ Writes every NewsEvent of an iterable, such as the ones of NewsCrawler.crawl """
+        for news_event in news_events:
+            self.write(news_event)
+        return self.count
+
+    def flush(self):
+        if self.output_format == "jsonl":
+            self.stream.flush()
+        elif self.batch:
+            columns = {"headline": [news_event.headline for news_event in self.batch],
+                       "link": [news_event.link for news_event in self.batch],
+                       "date": [news_event.date for news_event in self.batch],
+                       "paragraphs": [news_event.paragraphs for news_event in self.batch],
+                       "author": [news_event.author for news_event in self.batch],
+                       "location": [news_event.location for news_event in self.batch]}
+            self.stream.write_table(pyarrow.table(columns, schema=self.stream.schema))
+            self.batch = []
+
+    def close(self):
+        self.flush()
+        self.stream.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class HostRateLimiter:
+    """ Spaces out the requests sent to every host so at most rate requests
+        per second reach each of them, whatever the number of threads """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self.next_request = collections.defaultdict(float)
+        self.lock = threading.Lock()
+
+    def wait(self, url):
+        """ Blocks until a request to the host of url is allowed """
+        if not self.interval:
+            return
+        host = urllib.parse.urlsplit(url).netloc
+        with self.lock:
+            now = time.monotonic()
+            request_time = max(now, self.next_request[host])
+            self.next_request[host] = request_time + self.interval
+        if request_time > now:
+            time.sleep(request_time - now)
+
+
+class NewsCrawler:
+    """ Fetches the content of many NewsEvent objects concurrently through the
+        connection pool of SoupMaker, at most rate_per_host requests per second
+        on each host. Articles that fail are skipped and their (link, exception)
+        pairs kept in errors """
+
+    def __init__(self, max_workers=8, rate_per_host=4.0):
+        self.max_workers = max_workers
+        self.rate_limiter = HostRateLimiter(rate_per_host)
+        self.errors = []
+
+    def __fetch(self, news_event):
+        self.rate_limiter.wait(news_event.link)
+        return HetNieuwsblad.get_news_content(news_event.link)
+
+    def crawl(self, news_events):
+        """ Takes NewsEvent objects, such as the ones of HetNieuwsblad.get_headlines,
+            and yields NewsEvent objects with their content, in the same order """
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            pending = collections.deque()
+            for news_event in news_events:
+                pending.append((news_event, executor.submit(self.__fetch, news_event)))
+                while len(pending) > self.max_workers * 2:
+                    yield from self.__collect(*pending.popleft())
+            while pending:
+                yield from self.__collect(*pending.popleft())
+
+    def __collect(self, news_event, future):
+        try:
+            yield future.result()
+        except ScrapingError as scraping_error:
+            self.errors.append((news_event.link, scraping_error))
+
+
+class HeadlinePoller:
+    """ Polls HetNieuwsblad main pages and yields only the NewsEvent objects of articles
+        that are new or whose headline changed since they were last seen, with their content.
+        Seen articles are keyed by the id of their dmf<date>_<id> url and saved in a JSON
+        state file, so a restart does not fetch the articles it already has again """
+
+    ARTICLE_ID_REGEX = re.compile(r"/dmf\d+_(?P<id>\d+)", re.I)
+
+    def __init__(self, main_pages, state_file=None, crawler=None, interval=60, max_seen=10000):
+        self.main_pages = main_pages
+        self.state_file = state_file
+        self.crawler = crawler or NewsCrawler()
+        self.interval = interval
+        self.max_seen = max_seen
+        self.errors = []
+        self.seen = self.__load_state() if state_file else {}
+
+    @classmethod
+    def get_article_id(cls, link):
+        """ Returns the article id of a HetNieuwsblad url, the url itself if it has none """
+        match = cls.ARTICLE_ID_REGEX.search(link)
+        return match.group("id") if match else link
+
+    def __load_state(self):
+        try:
+            with open(self.state_file) as state_file:
+                return json.load(state_file)["seen"]
+        except (IOError, ValueError, KeyError):
+            return {}
+
+    def __save_state(self):
+        # the oldest articles are forgotten first, they dropped off the main pages long ago
+        for article_id in list(self.seen)[:max(len(self.seen) - self.max_seen, 0)]:
+            del self.seen[article_id]
+        temporary = self.state_file + ".tmp"
+        with open(temporary, "w") as state_file:
+            json.dump({"seen": self.seen}, state_file)
+        os.replace(temporary, self.state_file)
+
+    def __get_changed_headlines(self):
+        """ Only the first teaser of an article in a round is compared with the seen one, a
+            page often links an article twice with different texts (lead and 'most read') """
+        changed = collections.OrderedDict()
+        found = set()
+        for main_page in self.main_pages:
+            try:
+                headlines = list(HetNieuwsblad.get_headlines(main_page))
+            except ScrapingError as scraping_error:
+                self.errors.append((main_page, scraping_error))
+                continue
+            for news_event in headlines:
+                article_id = self.get_article_id(news_event.link)
+                if article_id in found:
+                    continue
+                found.add(article_id)
+                if self.seen.get(article_id) != news_event.headline:
+                    changed[article_id] = news_event
+        return changed
+
+    def poll(self):
+        """ Polls every main page once and yields the new and updated NewsEvent objects.
+            Main pages and articles that can not be retrieved in this round are kept in
+            errors and crawler.errors, which are emptied at the start of every round,
+            and polled again in the next round """
+        self.errors = []
+        self.crawler.errors = []
+        changed = self.__get_changed_headlines()
+        headlines = {news_event.link: news_event.headline for news_event in changed.values()}
+        try:
+            for news_event in self.crawler.crawl(changed.values()):
+                article_id = self.get_article_id(news_event.link)
+                self.seen.pop(article_id, None)
+                self.seen[article_id] = headlines[news_event.link]
+                yield news_event
+        finally:
+            # also saves the articles already yielded when the consumer stops early
+            if self.state_file and changed:
+                self.__save_state()
+
+    def run(self, rounds=None):
+        """ Polls the main pages every interval seconds, rounds times or forever,
+            and yields the new and updated NewsEvent objects as they come in """
+        round_number = 0
+        while rounds is None or round_number < rounds:
+            started = time.monotonic()
+            yield from self.poll()
+            round_number += 1
+            if rounds is None or round_number < rounds:
+                time.sleep(max(self.interval - (time.monotonic() - started), 0))
+
+
 def main():
-    headlines = HetNieuwsblad.get_headlines(HetNieuwsblad.MAIN_PAGE_NEWS)
-    for headline in headlines:
-        print(headline)
+    flags_parser = argparse.ArgumentParser(description="Prints the headlines of nieuwsblad.be and an example article")
+    instrumentation.add_arguments(flags_parser)
+    arguments = flags_parser.parse_args()
 
-    news_event = HetNieuwsblad.get_news_content(HetNieuwsblad.NEWS_CONTENT_EXAMPLE)
-    print(news_event.get_content())
+    with instrumentation.session(arguments.stats, arguments.profile):
+        try:
+            headlines = HetNieuwsblad.get_headlines(HetNieuwsblad.MAIN_PAGE_NEWS)
+            for headline in headlines:
+                print(headline)
+
+            news_event = HetNieuwsblad.get_news_content(HetNieuwsblad.NEWS_CONTENT_EXAMPLE)
+            print(news_event.get_content())
+        except ScrapingError as scraping_error:
+            print(scraping_error)
+            sys.exit(1)
 
 
 if __name__ == "__main__":
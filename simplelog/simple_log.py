@@ -1,65 +1,763 @@
-#!/usr/bin/python2
+#!/usr/bin/python3
 # Description: Command line tool to scan a file entries matching them
 # against a given regex and store them in a new file or print them
 # to the standard output
 
 import argparse
+import bisect
+import collections
+import concurrent.futures
+import contextlib
+import ctypes
+import ctypes.util
+import datetime
+import gzip
+import importlib.util
+import json
+import mmap
+import os
 import re
+import select
 import sys
+import time
+import types
 
+try:
+    from re import _parser as sre_parse
+except ImportError:
+    import sre_parse
 
-def append_to_file(output_file, line):
-    """ Appends log entries to output file. If file does not exists
-        a new one is made """
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# --stats and --profile come from instrumentation.py at the root of the repository. It is loaded by
+# path so the tool runs from any directory, a copy of the tool on its own runs without the two flags
+try:
+    instrumentation_spec = importlib.util.spec_from_file_location("instrumentation", os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), os.pardir, "instrumentation.py"))
+    instrumentation = importlib.util.module_from_spec(instrumentation_spec)
+    instrumentation_spec.loader.exec_module(instrumentation)
+except FileNotFoundError:
+    instrumentation = types.SimpleNamespace(
+        stats=types.SimpleNamespace(stage=lambda name: contextlib.nullcontext(), count=lambda name, amount=1: None,
+                                    iterate=lambda name, iterable: iterable),
+        add_arguments=lambda parser: parser.set_defaults(stats=False, profile=None),
+        session=lambda enable_stats=False, profile_file=None: contextlib.nullcontext())
+
+CHUNK_SIZE = 16 * 1024 * 1024
+OUTPUT_BUFFER_SIZE = 1024 * 1024
+SAMPLE_SIZE = 1024 * 1024
+
+# patterns compiled once in every worker process
+worker_patterns = None
+
+# ascii letters that unicode case-insensitive matching also pairs with non-ascii
+# characters (K with the kelvin sign, s with the long s, i with the dotless i)
+UNSAFE_IGNORECASE_LETTERS = "iksIKS"
+
+
+def parse_size(size):
+    """ converts a size such as 1048576, 512K, 100M or 2G to bytes """
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+    size = size.strip().upper()
+    if size[-1:] in units:
+        return int(size[:-1]) * units[size[-1]]
+    return int(size)
+
+
+class OutputWriter:
+    """ Appends log entries to an output file kept open for the whole scan.
+        Entries are batched in memory and written in one call once
+        buffer_size bytes are pending or flush_interval seconds have passed.
+        Output can be gzip or zstd compressed and rotated once rotate_size
+        uncompressed bytes have been written to a file, the next files
+        being named <output>.1, <output>.2, ... before the compression
+        extension """
+
+    extensions = {"gzip": ".gz", "zstd": ".zst"}
+
+    def __init__(self, output_file, buffer_size=OUTPUT_BUFFER_SIZE, flush_interval=1.0, compression=None,
+                 rotate_size=None):
+        if compression == "zstd" and zstandard is None:
+            raise ValueError("zstd compression needs the zstandard package")
+        self.extension = self.extensions.get(compression, "")
+        if self.extension and output_file.endswith(self.extension):
+            output_file = output_file[:-len(self.extension)]
+        self.base_file = output_file
+        self.output_file = output_file + self.extension
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.compression = compression
+        self.rotate_size = rotate_size
+        self.volume = 0
+        self.written = 0
+        self.pending = []
+        self.pending_size = 0
+        self.last_flush = time.monotonic()
+        self.stream = self.__open(self.output_file)
+
+    def __open(self, path):
+        if self.compression == "gzip":
+            return gzip.open(path, "ab")
+        if self.compression == "zstd":
+            return zstandard.ZstdCompressor().stream_writer(open(path, "ab"))
+        return open(path, "ab")
+
+    def __rotate(self):
+        self.stream.close()
+        self.volume += 1
+        self.written = 0
+        self.stream = self.__open("{}.{}{}".format(self.base_file, self.volume, self.extension))
+
+    def write(self, line):
+        """ Queues a log entry, flushing when the buffer is full or stale """
+        data = (line + "\n").encode("utf-8")
+        if self.rotate_size and self.written + self.pending_size + len(data) > self.rotate_size \
+                and self.written + self.pending_size:
+            self.flush()
+            self.__rotate()
+        self.pending.append(data)
+        self.pending_size += len(data)
+        if self.pending_size >= self.buffer_size or time.monotonic() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """ Writes every queued entry to the current output file """
+        if self.pending:
+            with instrumentation.stats.stage("write"):
+                self.stream.write(b"".join(self.pending))
+            instrumentation.stats.count("bytes written", self.pending_size)
+            self.written += self.pending_size
+            self.pending = []
+            self.pending_size = 0
+        self.stream.flush()
+        self.last_flush = time.monotonic()
+
+    def close(self):
+        self.flush()
+        self.stream.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def get_chunks(filename, chunk_size=CHUNK_SIZE, start=0, end=None):
+    """ yield (start, end) byte offsets of chunks of about chunk_size bytes
+        that always end right after a newline or at the end of the file.
+        start and end limit the chunks to a region starting on a line """
+    with open(filename, "rb") as file_object:
+        file_size = os.fstat(file_object.fileno()).st_size
+        if end is not None:
+            file_size = min(file_size, end)
+        if start >= file_size:
+            return
+        with mmap.mmap(file_object.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            while start < file_size:
+                newline = mapped.find(b"\n", min(start + chunk_size, file_size) - 1)
+                end = file_size if newline == -1 else newline + 1
+                yield start, end
+                start = end
+
+
+def get_literals(subpattern, ignorecase):
+    """ returns the runs of literal characters that every match of a parsed
+        regex contains. Characters that can not be found in raw bytes
+        without decoding break a run """
+    runs = []
+    current = []
+    for op, av in subpattern:
+        if op is sre_parse.LITERAL and av < 128 and not (ignorecase and chr(av) in UNSAFE_IGNORECASE_LETTERS):
+            current.append(chr(av))
+            continue
+        if op is sre_parse.AT:
+            continue
+        runs.append("".join(current))
+        current = []
+        if op is sre_parse.SUBPATTERN and not av[1] and not av[2]:
+            runs.extend(get_literals(av[-1], ignorecase))
+        elif op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT) and av[0] >= 1:
+            runs.extend(get_literals(av[2], ignorecase))
+    runs.append("".join(current))
+    return runs
+
+
+def get_required_literals(pattern):
+    """ returns the literals, as bytes, that every line matching a compiled
+        pattern contains, lowercased if the pattern ignores case. An empty
+        list if there is no such literal """
+    ignorecase = bool(pattern.flags & re.IGNORECASE)
     try:
-        with open(output_file, mode="a+") as output:
-            output.write(line + "\n")
-    except IOError as io_error:
-        print io_error
-        sys.exit(1)
+        literals = get_literals(sre_parse.parse(pattern.pattern, pattern.flags), ignorecase)
+    except (re.error, TypeError, ValueError):
+        return []
+    literals = {(literal.lower() if ignorecase else literal).encode("ascii") for literal in literals if literal}
+    return sorted(literals, key=len, reverse=True)
+
+
+class PatternSet:
+    """ Matches several compiled patterns against the lines of a chunk of
+        bytes in a single pass. When every pattern has a required literal,
+        the rarest literal of each pattern is searched in the raw bytes first
+        and only the lines containing one are decoded and handed to the regex
+        engine """
+
+    def __init__(self, patterns):
+        self.patterns = list(patterns)
+        self.literals = [get_required_literals(pattern) for pattern in self.patterns]
+        self.ignorecase = [bool(pattern.flags & re.IGNORECASE) for pattern in self.patterns]
+
+    def __scan_candidates(self, data, lowered, literals):
+        candidates = {}
+        for index, literal in enumerate(literals):
+            haystack = lowered if self.ignorecase[index] else data
+            position = haystack.find(literal)
+            while position != -1:
+                start = data.rfind(b"\n", 0, position) + 1
+                end = data.find(b"\n", position)
+                if end == -1:
+                    end = len(data)
+                candidates.setdefault(start, [end]).append(index)
+                position = haystack.find(literal, end)
+
+        matches = []
+        for start in sorted(candidates):
+            end, *indices = candidates[start]
+            log_entry = data[start:end].decode("utf-8", errors="replace")
+            matched = tuple(index for index in indices if self.patterns[index].search(log_entry))
+            if matched:
+                matches.append((log_entry.strip(), matched))
+        return matches
+
+    def __scan_lines(self, data):
+        text = data.decode("utf-8", errors="replace")
+        if text.endswith("\n"):
+            text = text[:-1]
+        if len(self.patterns) == 1:
+            search = self.patterns[0].search
+            return [(log_entry.strip(), (0,)) for log_entry in text.split("\n") if search(log_entry)]
 
+        searches = list(enumerate(pattern.search for pattern in self.patterns))
+        matches = []
+        for log_entry in text.split("\n"):
+            matched = tuple(index for index, search in searches if search(log_entry))
+            if matched:
+                matches.append((log_entry.strip(), matched))
+        return matches
 
-def get_file_entries(filename, pattern):
-    """ yield all log entries that match the pattern """
+    def scan(self, data):
+        """ returns a (stripped entry, indices of the matching patterns) tuple
+            for every line of data matching at least one pattern, in order.
+            Literals found on most lines filter nothing, then every line is
+            decoded and searched """
+        if all(self.literals):
+            # picks the rarest literal of every pattern from a sample of the data
+            sample = data[:SAMPLE_SIZE]
+            lowered_sample = sample.lower() if any(self.ignorecase) else sample
+            literals = []
+            hits = 0
+            for pattern_literals, ignorecase in zip(self.literals, self.ignorecase):
+                haystack = lowered_sample if ignorecase else sample
+                count, literal = min((haystack.count(literal), literal) for literal in pattern_literals)
+                literals.append(literal)
+                hits += count
+            if hits * 8 < sample.count(b"\n") + 1:
+                lowered = data.lower() if any(self.ignorecase) else data
+                return self.__scan_candidates(data, lowered, literals)
+        return self.__scan_lines(data)
+
+
+def scan_chunk(filename, start, end, patterns=None):
+    """ returns the matches of the entries between two byte offsets, see PatternSet.scan """
+    patterns = patterns or worker_patterns
+    with open(filename, "rb") as file_object, \
+            mmap.mmap(file_object.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        return patterns.scan(mapped[start:end])
+
+
+def init_worker(patterns):
+    global worker_patterns
+    worker_patterns = patterns
+
+
+def get_matches(filename, patterns, jobs=1, chunk_size=CHUNK_SIZE, start=0, end=None):
+    """ yield a (entry, indices of the matching patterns) tuple for every log
+        entry that matches a pattern of a PatternSet, in file order.
+        The file is memory mapped and split in newline aligned chunks
+        that are searched by a pool of processes. Only a few chunks per
+        process are in flight at once, so memory use does not grow with
+        the size of the file. start and end limit the scan to a region """
     try:
-        with open(filename, 'r') as file_object:
-            for log_entry in file_object.readlines():
-                matches_pattern = re.search(pattern, log_entry)
-                if matches_pattern:
-                    yield str.strip(log_entry)
+        chunks = get_chunks(filename, chunk_size, start, end)
+        region_size = (os.path.getsize(filename) if end is None else end) - start
+        if jobs <= 1 or region_size <= chunk_size:
+            for start, end in chunks:
+                yield from scan_chunk(filename, start, end, patterns)
+            return
+
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs, initializer=init_worker,
+                                                    initargs=(patterns,)) as executor:
+            pending = collections.deque()
+            for start, end in chunks:
+                pending.append(executor.submit(scan_chunk, filename, start, end))
+                if len(pending) > jobs * 2:
+                    yield from pending.popleft().result()
+            while pending:
+                yield from pending.popleft().result()
     except IOError as io_error:
-        print io_error
+        print(io_error)
         sys.exit(1)
 
 
+def get_file_entries(filename, pattern, jobs=1, chunk_size=CHUNK_SIZE):
+    """ yield all log entries that match the pattern, in file order """
+    for log_entry, _ in get_matches(filename, PatternSet([pattern]), jobs, chunk_size):
+        yield log_entry
+
+
+class LogFormat:
+    """ Extracts the fields of a log entry with a regex of named groups. The
+        'timestamp' group is parsed with time_format, or as ISO 8601 when
+        time_format is None, and the 'level' group is uppercased """
+
+    def __init__(self, regex, time_format=None):
+        self.regex = re.compile(regex)
+        self.time_format = time_format
+
+    def parse_time(self, timestamp):
+        """ returns a timestamp string as seconds since the epoch, naive times being local """
+        if self.time_format:
+            parsed = datetime.datetime.strptime(timestamp, self.time_format)
+        else:
+            parsed = datetime.datetime.fromisoformat(timestamp.replace(",", ".").replace("Z", "+00:00"))
+        return parsed.timestamp()
+
+    def parse(self, log_entry):
+        """ returns a dictionary of the fields of a log entry, the timestamp
+            as seconds since the epoch. None if the entry does not match """
+        match = self.regex.match(log_entry)
+        if not match:
+            return None
+        fields = match.groupdict()
+        try:
+            if fields.get("timestamp"):
+                fields["timestamp"] = self.parse_time(fields["timestamp"])
+        except ValueError:
+            return None
+        if fields.get("level"):
+            fields["level"] = fields["level"].upper()
+        return fields
+
+
+LOG_FORMATS = {
+    # 2017-04-23 14:03:11,123 ERROR ... / 2017-04-23T14:03:11Z [warn] ...
+    "iso": LogFormat(r"\s*(?P<timestamp>\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}:\d{2}(?:[.,]\d+)?(?:Z|[+-]\d{2}:?\d{2})?)"
+                     r"(?:\s+\[?(?P<level>[A-Za-z]+)\]?)?"),
+    # 127.0.0.1 - - [23/Apr/2017:14:03:11 +0200] "GET / HTTP/1.1" 200 512
+    "common": LogFormat(r'(?P<host>\S+) \S+ (?P<user>\S+) \[(?P<timestamp>[^\]]+)\] "(?P<request>[^"]*)" '
+                        r'(?P<status>\d{3}) (?P<size>\S+)', "%d/%b/%Y:%H:%M:%S %z"),
+}
+
+
+class TimeIndex:
+    """ Sparse index of a log file kept next to it as '<filename>.idx'. The
+        file is sampled every stride bytes and the first sample of every
+        time bucket is stored with the byte offset of its line, so a time
+        range query only scans the region of the file between the buckets
+        around it. Entries are expected in roughly chronological order.
+        An index of a file that grew is extended, it is rebuilt if the file
+        was replaced or truncated. With index_directory the index is kept
+        there instead, and if it can not be saved the index built in memory
+        is used for this run only """
+
+    def __init__(self, filename, log_format, format_name, bucket=60, stride=64 * 1024, index_directory=None):
+        self.filename = filename
+        self.index_file = filename + ".idx"
+        if index_directory:
+            self.index_file = os.path.join(index_directory, os.path.basename(self.index_file))
+        self.log_format = log_format
+        self.format_name = format_name
+        self.bucket = bucket
+        self.stride = stride
+        self.times = []
+        self.offsets = []
+        self.sampled = 0
+
+    def __load(self, stat):
+        try:
+            with open(self.index_file) as index_file:
+                state = json.load(index_file)
+        except (IOError, ValueError):
+            return
+        if state.get("inode") != stat.st_ino or state.get("size", 0) > stat.st_size \
+                or state.get("format") != self.format_name or state.get("bucket") != self.bucket \
+                or state.get("stride") != self.stride:
+            return
+        self.times = state["times"]
+        self.offsets = state["offsets"]
+        self.sampled = state["sampled"]
+
+    def __save(self, stat):
+        temporary = self.index_file + ".tmp"
+        try:
+            with open(temporary, "w") as index_file:
+                json.dump({"inode": stat.st_ino, "size": stat.st_size, "sampled": self.sampled,
+                           "format": self.format_name, "bucket": self.bucket, "stride": self.stride,
+                           "times": self.times, "offsets": self.offsets}, index_file)
+            os.replace(temporary, self.index_file)
+        except IOError as io_error:
+            print("Index not saved: {}".format(io_error), file=sys.stderr)
+            with contextlib.suppress(IOError):
+                os.remove(temporary)
+
+    def __sample(self, file_object, offset, size):
+        """ returns (time, line offset) of the first parsable entry at or after offset """
+        file_object.seek(offset)
+        if offset:
+            offset += len(file_object.readline())
+        while offset < size:
+            line = file_object.readline()
+            fields = self.log_format.parse(line.decode("utf-8", errors="replace"))
+            if fields and fields.get("timestamp") is not None:
+                return fields["timestamp"], offset
+            offset += len(line)
+        return None, size
+
+    def update(self):
+        """ loads the index, samples the part of the file not indexed yet and saves it """
+        stat = os.stat(self.filename)
+        self.__load(stat)
+
+        with open(self.filename, "rb") as file_object:
+            offset = self.sampled
+            while offset < stat.st_size:
+                timestamp, line_offset = self.__sample(file_object, offset, stat.st_size)
+                if timestamp is None:
+                    break
+                bucket = timestamp - timestamp % self.bucket
+                if not self.times or bucket > self.times[-1]:
+                    self.times.append(bucket)
+                    self.offsets.append(line_offset)
+                offset = max(offset + self.stride, line_offset + 1)
+        # the last stride is sampled again once the file grows
+        self.sampled = max(self.sampled, stat.st_size - self.stride, 0)
+        self.__save(stat)
+        return self
+
+    def get_region(self, since=None, until=None):
+        """ returns the (start, end) byte offsets of the region holding the
+            entries between two times given as seconds since the epoch """
+        start = 0
+        end = None
+        if since is not None:
+            position = bisect.bisect_right(self.times, since) - 1
+            if position > 0:
+                start = self.offsets[position - 1]
+        if until is not None:
+            position = bisect.bisect_right(self.times, until)
+            if position + 1 < len(self.offsets):
+                end = self.offsets[position + 1]
+        return start, end
+
+
+class ChangeWatcher:
+    """ Waits for changes in the directory of a file. Uses inotify on Linux
+        and falls back to sleeping for the poll interval elsewhere. Even with
+        inotify the wait never lasts longer than the poll interval """
+
+    # inotify event masks, see <sys/inotify.h>
+    IN_MODIFY = 0x002
+    IN_MOVED_FROM = 0x040
+    IN_MOVED_TO = 0x080
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+
+    def __init__(self, filename, poll_interval=1.0):
+        self.poll_interval = poll_interval
+        self.inotify_fd = None
+        library = ctypes.util.find_library("c")
+        if not sys.platform.startswith("linux") or not library:
+            return
+        libc = ctypes.CDLL(library, use_errno=True)
+        if not hasattr(libc, "inotify_init1"):
+            return
+        inotify_fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if inotify_fd < 0:
+            return
+        mask = self.IN_MODIFY | self.IN_MOVED_FROM | self.IN_MOVED_TO | self.IN_CREATE | self.IN_DELETE
+        directory = os.path.dirname(os.path.abspath(filename))
+        if libc.inotify_add_watch(inotify_fd, os.fsencode(directory), mask) < 0:
+            os.close(inotify_fd)
+            return
+        self.inotify_fd = inotify_fd
+
+    def wait(self):
+        if self.inotify_fd is None:
+            time.sleep(self.poll_interval)
+            return
+        readable, _, _ = select.select([self.inotify_fd], [], [], self.poll_interval)
+        if readable:
+            try:
+                while os.read(self.inotify_fd, 65536):
+                    pass
+            except BlockingIOError:
+                pass
+
+    def close(self):
+        if self.inotify_fd is not None:
+            os.close(self.inotify_fd)
+            self.inotify_fd = None
+
+
+class FileFollower:
+    """ Follows a growing log file and matches only the bytes appended since
+        the last read. The inode and byte offset of the last complete line
+        processed are saved in a JSON checkpoint file, so a restart resumes
+        where the previous run stopped. A file replaced by a new one (rotated)
+        or truncated is read again from its start """
+
+    def __init__(self, filename, patterns, checkpoint=None, poll_interval=1.0, chunk_size=CHUNK_SIZE):
+        self.filename = filename
+        self.patterns = patterns
+        self.checkpoint = checkpoint
+        self.poll_interval = poll_interval
+        self.chunk_size = chunk_size
+        self.inode = None
+        self.offset = 0
+        self.file_object = None
+
+    def __load_checkpoint(self):
+        try:
+            with open(self.checkpoint) as checkpoint:
+                state = json.load(checkpoint)
+            return state["inode"], state["offset"]
+        except (IOError, ValueError, KeyError, TypeError):
+            return None, 0
+
+    def __save_checkpoint(self):
+        temporary = self.checkpoint + ".tmp"
+        with open(temporary, "w") as checkpoint:
+            json.dump({"inode": self.inode, "offset": self.offset}, checkpoint)
+        os.replace(temporary, self.checkpoint)
+
+    def __open(self, offset=0):
+        if self.file_object:
+            self.file_object.close()
+        self.file_object = open(self.filename, "rb")
+        self.inode = os.fstat(self.file_object.fileno()).st_ino
+        self.offset = offset
+
+    def __read_new_entries(self):
+        """ returns the matches in the complete lines appended since the last read, see PatternSet.scan """
+        entries = []
+        while True:
+            self.file_object.seek(self.offset)
+            data = self.file_object.read(self.chunk_size)
+            end = data.rfind(b"\n") + 1
+            while not end:
+                # a line longer than chunk_size, it is read on until its end
+                more = self.file_object.read(self.chunk_size)
+                if not more:
+                    return entries
+                newline = more.find(b"\n")
+                if newline >= 0:
+                    end = len(data) + newline + 1
+                data += more
+            entries.extend(self.patterns.scan(data[:end]))
+            self.offset += end
+
+    def __replaced(self):
+        """ True if the file was rotated or truncated since it was opened """
+        try:
+            stat = os.stat(self.filename)
+        except FileNotFoundError:
+            return False
+        return stat.st_ino != self.inode or stat.st_size < self.offset
+
+    def follow(self):
+        """ yield lists of (entry, indices of the matching patterns) tuples as
+            lines are appended to the file. The checkpoint is saved once a
+            list has been consumed """
+        inode, offset = self.__load_checkpoint() if self.checkpoint else (None, 0)
+        self.__open()
+        if inode == self.inode and offset <= os.fstat(self.file_object.fileno()).st_size:
+            self.offset = offset
+
+        watcher = ChangeWatcher(self.filename, self.poll_interval)
+        try:
+            while True:
+                entries = self.__read_new_entries()
+                if self.__replaced():
+                    # drain what was appended to the old file before switching
+                    entries.extend(self.__read_new_entries())
+                    self.__open()
+                    entries.extend(self.__read_new_entries())
+                if entries:
+                    yield entries
+                if self.checkpoint and self.offset != offset:
+                    self.__save_checkpoint()
+                    offset = self.offset
+                if not entries:
+                    watcher.wait()
+        finally:
+            watcher.close()
+            self.file_object.close()
+
+
 def main():
     options = argparse.ArgumentParser()
     options.add_argument("filename", help="target file", type=str)
     options.add_argument("regex", help="regex pattern matches log entries with regular expressions", type=str)
+    options.add_argument("-e", "--regexp", help="another regex pattern searched in the same pass, can be repeated",
+                         action="append", default=[])
     options.add_argument("-v", "--verbose", help="outputs matches to the standard output ", action="store_true")
-    options.add_argument("-o", "--output", help="destination output file", type=str)
+    options.add_argument("-o", "--output", help="destination output file. Repeat it once per regex to write the "
+                                                "matches of every regex to its own file", action="append",
+                         default=[])
+    options.add_argument("--buffer-size", help="bytes of matches buffered before writing to the output file, "
+                                               "accepts K, M and G suffixes (default: 1M)", type=parse_size,
+                         default=OUTPUT_BUFFER_SIZE)
+    options.add_argument("--flush-interval", help="seconds after which buffered matches are written anyway "
+                                                  "(default: 1)", type=float, default=1.0)
+    options.add_argument("--compress", help="compresses the output file", choices=["gzip", "zstd"], default=None)
+    options.add_argument("--rotate-size", help="starts a new numbered output file after this many bytes, "
+                                               "accepts K, M and G suffixes", type=parse_size, default=None)
+    options.add_argument("-f", "--follow", help="keeps watching the file and matches the entries appended to it",
+                         action="store_true")
+    options.add_argument("--checkpoint", help="with --follow, file where the last processed offset is saved so a "
+                                              "restart resumes from it", type=str, default=None)
+    options.add_argument("--poll-interval", help="with --follow, seconds between checks when inotify is not "
+                                                 "available (default: 1)", type=float, default=1.0)
+    options.add_argument("--format", help="log format used to parse entry fields (default: iso)",
+                         choices=sorted(LOG_FORMATS), default="iso")
+    options.add_argument("--format-regex", help="custom log format, a regex with named groups such as "
+                                                "(?P<timestamp>...) and (?P<level>...)", type=str, default=None)
+    options.add_argument("--time-format", help="strptime format of the timestamp group of --format-regex "
+                                               "(default: ISO 8601)", type=str, default=None)
+    options.add_argument("--since", help="only entries at or after this time, ex: '2017-04-23 14:00'", type=str)
+    options.add_argument("--until", help="only entries at or before this time, ex: '2017-04-23 14:05'", type=str)
+    options.add_argument("--level", help="only entries with this level, can be repeated", action="append",
+                         default=[])
+    options.add_argument("--bucket", help="seconds per time bucket of the '<filename>.idx' index used by --since "
+                                          "and --until (default: 60)", type=int, default=60)
+    options.add_argument("--index-dir", help="directory the '<filename>.idx' index is kept in, for logs in "
+                                             "read-only directories (default: next to the file)", type=str,
+                         default=None)
+    options.add_argument("-j", "--jobs", help="number of processes scanning the file (default: number of CPUs)",
+                         type=int, default=os.cpu_count() or 1)
+    instrumentation.add_arguments(options)
     arguments = options.parse_args()
 
+    regexes = [arguments.regex] + arguments.regexp
+    compiled_patterns = []
+    for regex in regexes:
+        try:
+            compiled_patterns.append(re.compile(pattern=regex, flags=re.IGNORECASE))
+        except re.error as re_error:
+            print("Regex error: " + re_error.args[0] + ". Used regex: '%s'" % regex)
+            sys.exit(1)
+    patterns = PatternSet(compiled_patterns)
+
+    if arguments.format_regex:
+        format_name = "custom:{}:{}".format(arguments.format_regex, arguments.time_format)
+        try:
+            log_format = LogFormat(arguments.format_regex, arguments.time_format)
+        except re.error as re_error:
+            print("Regex error: " + re_error.args[0] + ". Used format regex: '%s'" % arguments.format_regex)
+            sys.exit(1)
+    else:
+        format_name = arguments.format
+        log_format = LOG_FORMATS[arguments.format]
+
+    try:
+        since = datetime.datetime.fromisoformat(arguments.since).timestamp() if arguments.since else None
+        until = datetime.datetime.fromisoformat(arguments.until).timestamp() if arguments.until else None
+    except ValueError as value_error:
+        print("Time error: {}".format(value_error))
+        sys.exit(1)
+    levels = {level.upper() for level in arguments.level}
+    structured = since is not None or until is not None or bool(levels)
+
+    if len(arguments.output) not in (0, 1, len(regexes)):
+        print("Output error: give one output file or one per regex")
+        sys.exit(1)
+
+    if arguments.verbose:
+        for regex in regexes:
+            print("Used regex: <%s>" % regex)
+
+    outputs = []
     try:
-        compiled_pattern = re.compile(pattern=arguments.regex, flags=re.IGNORECASE)
-    except re.error as re_error:
-        print "Regex error: " + re_error.args[0] + ". Used regex: '%s'" % arguments.regex
+        for output_file in arguments.output:
+            outputs.append(OutputWriter(output_file, buffer_size=arguments.buffer_size,
+                                        flush_interval=arguments.flush_interval, compression=arguments.compress,
+                                        rotate_size=arguments.rotate_size))
+    except (IOError, ValueError) as output_error:
+        print(output_error)
         sys.exit(1)
 
-    if arguments.verbose and arguments.regex:
-        print "Used regex: <%s>" % arguments.regex
+    def emit(file_entry, indices):
+        if structured:
+            fields = log_format.parse(file_entry)
+            if not fields:
+                return
+            timestamp = fields.get("timestamp")
+            if (since is not None or until is not None) and timestamp is None:
+                return
+            if (since is not None and timestamp < since) or (until is not None and timestamp > until):
+                return
+            if levels and fields.get("level") not in levels:
+                return
+        instrumentation.stats.count("entries emitted")
 
-    for file_entry in get_file_entries(arguments.filename, compiled_pattern):
-        if arguments.output:
-            append_to_file(arguments.output, file_entry)
+        if len(outputs) > 1:
+            for index in indices:
+                outputs[index].write(file_entry)
+        elif outputs:
+            outputs[0].write(file_entry)
         else:
-            print file_entry
+            print(file_entry)
 
         if arguments.verbose:
-            print file_entry
+            print(file_entry)
+
+    with instrumentation.session(arguments.stats, arguments.profile):
+        try:
+            if arguments.follow:
+                follower = FileFollower(arguments.filename, patterns, checkpoint=arguments.checkpoint,
+                                        poll_interval=arguments.poll_interval)
+                for file_entries in instrumentation.stats.iterate("follow", follower.follow()):
+                    for file_entry, indices in file_entries:
+                        emit(file_entry, indices)
+                    for output in outputs:
+                        output.flush()
+                    sys.stdout.flush()
+            else:
+                start, end = 0, None
+                if since is not None or until is not None:
+                    with instrumentation.stats.stage("time index"):
+                        time_index = TimeIndex(arguments.filename, log_format, format_name, bucket=arguments.bucket,
+                                               index_directory=arguments.index_dir)
+                        start, end = time_index.update().get_region(since, until)
+                matches = get_matches(arguments.filename, patterns, jobs=arguments.jobs, start=start, end=end)
+                for file_entry, indices in instrumentation.stats.iterate("scan", matches):
+                    emit(file_entry, indices)
+                instrumentation.stats.count("bytes scanned", (os.path.getsize(arguments.filename) if end is None else end) - start)
+        except KeyboardInterrupt:
+            pass
+        except IOError as io_error:
+            print(io_error)
+            sys.exit(1)
+        finally:
+            for output in outputs:
+                output.close()
 
-    if arguments.output:
-        print arguments.output + " has been created."
+    for output in outputs:
+        print(output.output_file + " has been created.")
 
 
 if __name__ == '__main__':
@@ -19,70 +19,111 @@
     along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+import argparse
+import array
+import bisect
+import collections
+import concurrent.futures
+import contextlib
+import hashlib
+import importlib.util
 import json
+import os
+import shelve
+import sys
+import threading
+import time
+import types
+
 import requests
+import requests.adapters
+import urllib3.util.retry
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# --stats and --profile come from instrumentation.py at the root of the repository. It is loaded by
+# path so the tool runs from any directory, a copy of the tool on its own runs without the two flags
+try:
+    instrumentation_spec = importlib.util.spec_from_file_location("instrumentation", os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), os.pardir, "instrumentation.py"))
+    instrumentation = importlib.util.module_from_spec(instrumentation_spec)
+    instrumentation_spec.loader.exec_module(instrumentation)
+except FileNotFoundError:
+    instrumentation = types.SimpleNamespace(
+        stats=types.SimpleNamespace(stage=lambda name: contextlib.nullcontext(), count=lambda name, amount=1: None,
+                                    iterate=lambda name, iterable: iterable),
+        add_arguments=lambda parser: parser.set_defaults(stats=False, profile=None),
+        session=lambda enable_stats=False, profile_file=None: contextlib.nullcontext())
 
 
 class DirectionParser:
     """ Parses degrees to Cardinal, Ordinal or Secondary-Intercardinal directions """
 
-    directions = {
-        "north_w": {"base": 348.75, "top": 360, "cardinal": "north"},
-        "north_e": {"base": 0, "top": 11.25, "cardinal": "north"},
-        "north_north_east": {"base": 11.25, "top": 33.75, "cardinal": "north-north-east"},
-        "north_east": {"base": 33.75, "top": 56.25, "cardinal": "north-east"},
-        "east_north_east": {"base": 56.25, "top": 78.75, "cardinal": "east-north-east"},
-        "east": {"base": 78.75, "top": 101.25, "cardinal": "east"},
-        "east_south_east": {"base": 101.25, "top": 123.75, "cardinal": "east-south-east"},
-        "south_east": {"base": 123.75, "top": 146.25, "cardinal": "south-east"},
-        "south_south_east": {"base": 146.25, "top": 168.75, "cardinal": "south-south-east"},
-        "south": {"base": 168.75, "top": 191.25, "cardinal": "south"},
-        "south_south_west": {"base": 191.25, "top": 213.75, "cardinal": "south-south-west"},
-        "south_west": {"base": 213.75, "top": 236.25, "cardinal": "south-west"},
-        "west_south_west": {"base": 236.25, "top": 258.75, "cardinal": "west-south-west"},
-        "west": {"base": 258.75, "top": 281.25, "cardinal": "west"},
-        "west_north_west": {"base": 281.25, "top": 303.75, "cardinal": "west-north-west"},
-        "north_west": {"base": 303.75, "top": 326.25, "cardinal": "north-west"},
-        "north_north_west": {"base": 362.25, "top": 348.75, "cardinal": "north-north-west"},
-    }
+    # 16 sectors of 22.5 degrees, the first one centered on north (348.75 up to 11.25)
+    cardinals = ("north", "north-north-east", "north-east", "east-north-east",
+                 "east", "east-south-east", "south-east", "south-south-east",
+                 "south", "south-south-west", "south-west", "west-south-west",
+                 "west", "west-north-west", "north-west", "north-north-west")
+    sector = 22.5
 
     @classmethod
     def get_direction(cls, degrees):
         """ Takes a degrees argument as wind origin and returns a string of a cardinal,
         ordinal or secondary-intercardinal direction """
-        for val in cls.directions.values():
-            if val.get("base") <= degrees <= val.get("top"):
-                return val.get("cardinal")
+        return cls.cardinals[int((degrees % 360 + cls.sector / 2) // cls.sector) % 16]
+
+    @classmethod
+    def get_directions(cls, degrees):
+        """ Takes a sequence of degrees and returns their directions, as a NumPy array
+        if NumPy is installed """
+        if numpy is None:
+            return [cls.get_direction(value) for value in degrees]
+        sectors = ((numpy.asarray(degrees, dtype=float) % 360 + cls.sector / 2) // cls.sector).astype(int) % 16
+        return numpy.array(cls.cardinals)[sectors]
 
 
 class BeaufortScaleParser:
     """ Parses wind's speed into Beaufort scale wind speed definition """
 
-    scale = [
-        {"calm": {"level": 0, "base_speed": 0, "top_speed": 1}},
-        {"light air": {"level": 1, "base_speed": 1, "top_speed": 3}},
-        {"light breeze": {"level": 2, "base_speed": 4, "top_speed": 7}},
-        {"gentle breeze": {"level": 3, "base_speed": 8, "top_speed": 12}},
-        {"moderate breeze": {"level": 4, "base_speed": 13, "top_speed": 18}},
-        {"fresh breeze": {"level": 5, "base_speed": 19, "top_speed": 24}},
-        {"strong breeze": {"level": 6, "base_speed": 25, "top_speed": 31}},
-        {"high wind": {"level": 7, "base_speed": 32, "top_speed": 38}},
-        {"gale": {"level": 8, "base_speed": 39, "top_speed": 46}},
-        {"strong gale": {"level": 9, "base_speed": 47, "top_speed": 54}},
-        {"storm": {"level": 10, "base_speed": 55, "top_speed": 63}},
-        {"violent storm": {"level": 11, "base_speed": 64, "top_speed": 72}},
-        {"hurricane": {"level": 12, "base_speed": 73, "top_speed": 1000}},
-        {"calm": {"level": 1, "base_speed": 0, "top_speed": 1}}
-    ]
+    categories = ("calm", "light air", "light breeze", "gentle breeze", "moderate breeze", "fresh breeze",
+                  "strong breeze", "high wind", "gale", "strong gale", "storm", "violent storm", "hurricane")
+    # top speed of every level but hurricane, a speed between two levels belongs to the upper one
+    top_speeds = (1, 3, 7, 12, 18, 24, 31, 38, 46, 54, 63, 72)
+
+    @classmethod
+    def get_wind_level(cls, wind_speed):
+        """ Takes wind's speed as argument and returns its level, 0 to 12, in the Beaufort scale """
+        return bisect.bisect_left(cls.top_speeds, wind_speed)
 
     @classmethod
     def get_wind_category(cls, wind_speed):
         """ Takes wind's speed as argument and returns a string of its definition
          in the Beaufort scale """
-        for value in cls.scale:
-            for k, v in value.items():
-                if v.get("top_speed") >= wind_speed >= v.get("base_speed"):
-                    return k
+        return cls.categories[cls.get_wind_level(wind_speed)]
+
+    @classmethod
+    def get_wind_levels(cls, wind_speeds):
+        """ Takes a sequence of wind speeds and returns their Beaufort levels, as a NumPy
+        array if NumPy is installed """
+        if numpy is None:
+            return [cls.get_wind_level(wind_speed) for wind_speed in wind_speeds]
+        return numpy.searchsorted(cls.top_speeds, numpy.asarray(wind_speeds, dtype=float), side="left")
+
+    @classmethod
+    def get_wind_categories(cls, wind_speeds):
+        """ Takes a sequence of wind speeds and returns their Beaufort definitions, as a
+        NumPy array if NumPy is installed """
+        if numpy is None:
+            return [cls.get_wind_category(wind_speed) for wind_speed in wind_speeds]
+        return numpy.array(cls.categories)[cls.get_wind_levels(wind_speeds)]
 
 
 class CityNotFound(Exception):
@@ -96,39 +137,335 @@ class CityNotFound(Exception):
         return self.message
 
 
+class TTLCache:
+    """ Thread safe LRU cache whose entries expire ttl seconds after being stored
+    (never if ttl is None). An expired entry younger than ttl + stale_ttl is still
+    returned while a background thread fetches a fresh one. Concurrent lookups
+    of the same missing key share a single fetch. With a path, entries are also
+    kept in a shelve file so they survive restarts """
+
+    def __init__(self, maxsize=1024, ttl=300, stale_ttl=0, path=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.path = path
+        self.entries = collections.OrderedDict()
+        self.in_flight = {}
+        self.lock = threading.RLock()
+        self.stats = collections.Counter(hits=0, misses=0, stale_hits=0, coalesced=0, disk_hits=0)
+
+    def __lookup(self, key):
+        """ returns the (value, stored_at) entry of a key from memory or disk, or None """
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+            return entry
+        if self.path:
+            with shelve.open(self.path) as store:
+                entry = store.get(key)
+            if entry is not None:
+                self.stats["disk_hits"] += 1
+                self.__store(key, entry, persist=False)
+        return entry
+
+    def __store(self, key, entry, persist=True):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+        if persist and self.path:
+            with shelve.open(self.path) as store:
+                store[key] = entry
+
+    def __fetch(self, key, fetch, future):
+        try:
+            value = fetch()
+        except BaseException as exception:
+            with self.lock:
+                del self.in_flight[key]
+            future.set_exception(exception)
+        else:
+            with self.lock:
+                self.__store(key, (value, time.time()))
+                del self.in_flight[key]
+            future.set_result(value)
+
+    def get_or_fetch(self, key, fetch):
+        """ Returns the cached value of key, calling fetch() to get it when missing or expired """
+        with self.lock:
+            entry = self.__lookup(key)
+            if entry is not None:
+                value, stored_at = entry
+                age = time.time() - stored_at
+                if self.ttl is None or age < self.ttl:
+                    self.stats["hits"] += 1
+                    return value
+                if age < self.ttl + self.stale_ttl:
+                    self.stats["stale_hits"] += 1
+                    if key not in self.in_flight:
+                        self.in_flight[key] = concurrent.futures.Future()
+                        threading.Thread(target=self.__fetch, args=(key, fetch, self.in_flight[key]),
+                                         daemon=True).start()
+                    return value
+
+            future = self.in_flight.get(key)
+            is_owner = future is None
+            if is_owner:
+                self.stats["misses"] += 1
+                future = self.in_flight[key] = concurrent.futures.Future()
+            else:
+                self.stats["coalesced"] += 1
+
+        if is_owner:
+            self.__fetch(key, fetch, future)
+        return future.result()
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            if self.path:
+                with shelve.open(self.path) as store:
+                    store.clear()
+
+
 class WindForecast:
-    """ Wind forecast object """
+    """ Wind forecast object. Its attributes are slots, so instances carry no __dict__ """
+
+    __slots__ = ("location", "region", "latitude", "longitude", "beaufort",
+                 "speed", "origin", "country", "degrees", "direction")
 
     def __init__(self, **kwargs):
-        accepted_args = ["location", "region", "latitude", "longitude", "beaufort",
-                         "speed", "origin", "country", "degrees", "direction"]
         for arg in kwargs.keys():
-            if arg in accepted_args:
+            if arg in self.__slots__:
                 self.__setattr__(arg, kwargs.get(arg))
 
     def __str__(self):
         return "<WindGoes. Cat: {} Lat: {} Long: {}>".format(self.beaufort, self.latitude, self.longitude)
 
 
+class WindHistory:
+    """ Columnar store of wind readings. Every column is a typed array, 19 bytes
+    per reading in total, and is saved to its own raw binary file in a directory
+    so new readings are appended to the files and the columns can be memory mapped
+    (see open_memmap). Locations are stored as ids, their names are kept in
+    locations.json. Readings are expected to be appended in chronological order """
+
+    # column name, array typecode, NumPy dtype
+    columns = (("time", "d", "f8"), ("location_id", "I", "u4"), ("speed", "f", "f4"),
+               ("degrees", "h", "i2"), ("beaufort", "B", "u1"))
+
+    def __init__(self, path=None):
+        self.path = path
+        self.data = {name: array.array(typecode) for name, typecode, _ in self.columns}
+        self.location_ids = {}
+        self.saved = 0
+        if path and os.path.exists(os.path.join(path, "locations.json")):
+            self.__load()
+
+    def __column_file(self, name):
+        return os.path.join(self.path, name + ".bin")
+
+    def __load(self):
+        with open(os.path.join(self.path, "locations.json")) as meta_file:
+            meta = json.load(meta_file)
+        self.location_ids = meta["locations"]
+        for name, _, _ in self.columns:
+            with open(self.__column_file(name), "rb") as column_file:
+                self.data[name].fromfile(column_file, meta["rows"])
+            if meta["byteorder"] != sys.byteorder:
+                self.data[name].byteswap()
+        self.saved = meta["rows"]
+
+    def __len__(self):
+        return len(self.data["time"])
+
+    def get_location_id(self, location):
+        """ Returns the id of a location name, assigning a new one if needed """
+        return self.location_ids.setdefault(location, len(self.location_ids))
+
+    def append(self, wind_forecast, timestamp=None):
+        """ Appends the reading of a WindForecast object, taken at timestamp seconds
+        since the epoch (default: now) """
+        self.data["time"].append(time.time() if timestamp is None else timestamp)
+        self.data["location_id"].append(self.get_location_id(wind_forecast.location))
+        self.data["speed"].append(wind_forecast.speed)
+        self.data["degrees"].append(wind_forecast.degrees)
+        self.data["beaufort"].append(BeaufortScaleParser.get_wind_level(wind_forecast.speed))
+
+    def save(self):
+        """ Appends the readings not saved yet to the column files """
+        os.makedirs(self.path, exist_ok=True)
+        for name, _, _ in self.columns:
+            with open(self.__column_file(name), "r+b" if self.saved else "wb") as column_file:
+                column_file.seek(self.saved * self.data[name].itemsize)
+                column_file.truncate()
+                self.data[name][self.saved:].tofile(column_file)
+        self.saved = len(self)
+        temporary = os.path.join(self.path, "locations.json.tmp")
+        with open(temporary, "w") as meta_file:
+            json.dump({"rows": self.saved, "byteorder": sys.byteorder, "locations": self.location_ids}, meta_file)
+        os.replace(temporary, os.path.join(self.path, "locations.json"))
+
+    def query(self, location, since=None, until=None):
+        """ Returns a dictionary of columns holding the readings of a location between
+        two timestamps, both included. Columns are NumPy arrays if NumPy is installed """
+        location_id = self.location_ids.get(location)
+        times = self.data["time"]
+        start = 0 if since is None else bisect.bisect_left(times, since)
+        end = len(times) if until is None else bisect.bisect_right(times, until)
+        if numpy is not None:
+            columns = {name: numpy.frombuffer(self.data[name], dtype=dtype)[start:end]
+                       for name, _, dtype in self.columns}
+            mask = columns["location_id"] == location_id
+            return {name: column[mask] for name, column in columns.items()}
+        rows = [row for row in range(start, end) if self.data["location_id"][row] == location_id]
+        return {name: [self.data[name][row] for row in rows] for name, _, _ in self.columns}
+
+    @classmethod
+    def open_memmap(cls, path):
+        """ Maps the saved columns of a history directory as read-only NumPy arrays """
+        with open(os.path.join(path, "locations.json")) as meta_file:
+            meta = json.load(meta_file)
+        order = "<" if meta["byteorder"] == "little" else ">"
+        return {name: numpy.memmap(os.path.join(path, name + ".bin"), dtype=order + dtype, mode="r",
+                                   shape=(meta["rows"],))
+                for name, _, dtype in cls.columns}
+
+
+def decode_json(data):
+    """ Parses a json string or bytes, with orjson when it is installed """
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+class HTTPProvider:
+    """ Requests API responses over HTTP through one requests session shared by every
+    thread, keeping pool_size keep-alive connections open. Requests time out after
+    timeout (connect, read) seconds and failed connections or 429/5xx responses are
+    retried, waiting backoff_factor * 2 ** retry seconds """
+
+    def __init__(self, timeout=(3.05, 10), pool_size=16, retries=3, backoff_factor=0.5):
+        self.timeout = timeout
+        retry = urllib3.util.retry.Retry(total=retries, backoff_factor=backoff_factor,
+                                         status_forcelist=(429, 500, 502, 503, 504),
+                                         allowed_methods=frozenset(["GET"]))
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size,
+                                                max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def get(self, url):
+        """ Executes a GET http request and returns the response body as bytes """
+        response = self.session.get(url, timeout=self.timeout)
+        response.raise_for_status()
+        return response.content
+
+
+class RecordingProvider:
+    """ Wraps another provider and saves every response in a fixtures directory
+    that a ReplayProvider can serve later """
+
+    def __init__(self, provider, directory):
+        self.provider = provider
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def get(self, url):
+        data = self.provider.get(url)
+        with open(ReplayProvider.get_fixture_path(self.directory, url), "wb") as fixture:
+            fixture.write(data)
+        return data
+
+
+class ReplayProvider:
+    """ Serves recorded responses from a fixtures directory, without network. Every
+    fixture is read from disk once. A url that was never recorded raises
+    FileNotFoundError """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.responses = {}
+
+    @staticmethod
+    def get_fixture_path(directory, url):
+        """ Returns the path of the fixture of a url, named after its sha1 """
+        return os.path.join(directory, hashlib.sha1(url.encode("utf-8")).hexdigest() + ".json")
+
+    def get(self, url):
+        data = self.responses.get(url)
+        if data is None:
+            with open(self.get_fixture_path(self.directory, url), "rb") as fixture:
+                data = self.responses[url] = fixture.read()
+        return data
+
+
 class YahooForecastAPIHandler:
     """ Retrieves forecast information from Yahoo Forecast API """
 
+    woeid_url = "https://query.yahooapis.com/v1/public/yql?q=select%20woeid%20from%20geo.places(1)%20" \
+                "where%20text%3D%22{cityname}%2C%20be%22&format=json"
+
     wind_forecast_url = "https://query.yahooapis.com/v1/public/yql?q=select%20*%20from%20weather." \
-                        "forecast%20where%20woeid%20in%20(select%20woeid%20from%20geo.places(1)%20" \
-                        "where%20text%3D%22{cityname}%2C%20be%22)&format=json&env=store%3A%2F" \
+                        "forecast%20where%20woeid%3D{woeid}&format=json&env=store%3A%2F" \
                         "%2Fdatatables.org%2Falltableswithkeys"
 
-    @staticmethod
-    def __request(url):
-        """ Executes a GET http request, parses json string and returns a dictionary """
-        response = requests.get(url).text
-        data = json.loads(response)
-        return data
+    # a city's woeid never changes, forecasts are refreshed every few minutes and an
+    # expired forecast is served for up to 10 more minutes while it is refreshed
+    woeid_cache = TTLCache(maxsize=4096, ttl=None)
+    forecast_cache = TTLCache(maxsize=1024, ttl=300, stale_ttl=600)
+
+    # transport the API responses are requested through
+    provider = None
+    provider_lock = threading.Lock()
+    # default number of concurrent requests of get_wind_forecasts
+    pool_size = 16
+
+    @classmethod
+    def get_provider(cls):
+        """ Returns the forecast provider, an HTTPProvider unless another one was set """
+        with cls.provider_lock:
+            if cls.provider is None:
+                cls.provider = HTTPProvider(pool_size=cls.pool_size)
+            return cls.provider
+
+    @classmethod
+    def __request(cls, url):
+        """ Requests a url through the provider, parses json string and returns a dictionary """
+        with instrumentation.stats.stage("request"):
+            data = cls.get_provider().get(url)
+        instrumentation.stats.count("response bytes", len(data))
+        with instrumentation.stats.stage("json"):
+            return decode_json(data)
+
+    @classmethod
+    def get_woeid(cls, location):
+        """ Returns the Yahoo where-on-earth id of a city, resolved once and cached """
+        return cls.woeid_cache.get_or_fetch(location, lambda: cls.__fetch_woeid(location))
+
+    @classmethod
+    def __fetch_woeid(cls, location):
+        parsed_json = cls.__request(cls.woeid_url.format(cityname=location))
+        data = parsed_json.get("query").get("results")
+        if not data:
+            raise CityNotFound("{} was not found".format(location))
+        return data.get("place").get("woeid")
 
     @classmethod
     def get_wind_forecast(cls, location):
+        """ Returns the WindForecast object of a location, from the forecast cache if it is fresh """
+        return cls.forecast_cache.get_or_fetch(location, lambda: cls.__fetch_wind_forecast(location))
+
+    @classmethod
+    def get_cache_stats(cls):
+        """ Returns the hit and miss counters of the woeid and forecast caches """
+        return {"woeid": dict(cls.woeid_cache.stats), "forecast": dict(cls.forecast_cache.stats)}
+
+    @classmethod
+    def __fetch_wind_forecast(cls, location):
         """ Requests wind information to yahoo forecast api, parses json, returns WindForecast object """
-        parsed_json = cls.__request(cls.wind_forecast_url.format(cityname=location))
+        parsed_json = cls.__request(cls.wind_forecast_url.format(woeid=cls.get_woeid(location)))
         data = parsed_json.get("query").get("results")
         if data:
             global_data = data.get("channel")
@@ -155,24 +492,50 @@ class YahooForecastAPIHandler:
         else:
             raise CityNotFound("{} was not found".format(location))
 
+    @classmethod
+    def get_wind_forecasts(cls, locations, max_workers=None, return_exceptions=False):
+        """ Requests the wind forecast of many locations concurrently, at most max_workers
+        at a time (default: pool_size), and returns a list of WindForecast objects in the
+        order of the locations. If return_exceptions, a failed location gets its exception
+        in the list instead of it being raised """
+        max_workers = max_workers or cls.pool_size
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(cls.get_wind_forecast, location) for location in locations]
+
+        wind_forecasts = []
+        for future in futures:
+            exception = future.exception()
+            if exception is None:
+                wind_forecasts.append(future.result())
+            elif return_exceptions:
+                wind_forecasts.append(exception)
+            else:
+                raise exception
+        return wind_forecasts
+
 
 def main():
-    wind_forecast_london = YahooForecastAPIHandler.get_wind_forecast("London")
-
-    print("Object: ", wind_forecast_london)
-
-    # geographic data
-    print("Location: ", wind_forecast_london.location)
-    print("Country: ", wind_forecast_london.country)
-    print("Region: ", wind_forecast_london.region)
-    print("Latitude: ", wind_forecast_london.latitude)
-    print("Longitude: ", wind_forecast_london.longitude)
-
-    # wind forecast data
-    print("Wind speed: ", wind_forecast_london.speed)
-    print("Wind speed Beaufort definition: ", wind_forecast_london.beaufort)
-    print("Wind cardinal direction: ", wind_forecast_london.direction)
-    print("Wind origin in degrees: ", wind_forecast_london.degrees)
+    flags_parser = argparse.ArgumentParser(description="Prints the wind forecast of London")
+    instrumentation.add_arguments(flags_parser)
+    arguments = flags_parser.parse_args()
+
+    with instrumentation.session(arguments.stats, arguments.profile):
+        wind_forecast_london = YahooForecastAPIHandler.get_wind_forecast("London")
+
+        print("Object: ", wind_forecast_london)
+
+        # geographic data
+        print("Location: ", wind_forecast_london.location)
+        print("Country: ", wind_forecast_london.country)
+        print("Region: ", wind_forecast_london.region)
+        print("Latitude: ", wind_forecast_london.latitude)
+        print("Longitude: ", wind_forecast_london.longitude)
+
+        # wind forecast data
+        print("Wind speed: ", wind_forecast_london.speed)
+        print("Wind speed Beaufort definition: ", wind_forecast_london.beaufort)
+        print("Wind cardinal direction: ", wind_forecast_london.direction)
+        print("Wind origin in degrees: ", wind_forecast_london.degrees)
 
 
 if __name__ == "__main__":